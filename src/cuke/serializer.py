@@ -57,7 +57,31 @@ def _check_format(format,known_formats):
             return True
     return False
 
-def deserialize(serializer,wire_data,wire_format=None):
+# Wire formats found by sniffing, keyed by (serializer name, translator,
+# affinity key), so that unlabeled streams are only sniffed once
+_FORMAT_AFFINITY = {}
+_FORMAT_AFFINITY_SIZE = 1024
+
+def _accepts_out(func):
+    try:
+        return 'out' in inspect.getargspec(func).args
+    except TypeError:
+        return False
+
+def _call_with_out(serializer,func,out,*args):
+    if out is None:
+        return func(*args)
+    if not _accepts_out(func):
+        raise SerializationError('%s cannot deserialize into an output buffer' % serializer.get_name())
+    return func(*args,out=out)
+
+def deserialize(serializer,wire_data,wire_format=None,out=None):
+    """Deserialize wire_data using the given serializer.
+    
+    If out is given, it must be a preallocated array of the shape the
+    serializer produces; the deserialized values are written into it and it
+    is returned, instead of allocating a new array. Only serializers whose
+    deserialize() accepts an out argument support this."""
     if wire_format and not serializer._call_can_deserialize(wire_format):
         raise SerializationError('Serializer %s does not accept format %s' % (serializer.get_name(), wire_format))
     if wire_data is None:
@@ -67,7 +91,7 @@ def deserialize(serializer,wire_data,wire_format=None):
             return None
     if serializer._call_is_binary(wire_format):
         wire_data = _binary_convert(serializer, wire_format, wire_data, str2bin=True, file_ok=True)
-    deserialized_data = serializer._call_deserialize(wire_data,wire_format)
+    deserialized_data = serializer._call_deserialize(wire_data,wire_format,out=out)
     
     return deserialized_data
 
@@ -237,6 +261,46 @@ class SerializerBase(object):
         """Serialize the given data into the given wire format."""
         return NotImplemented
     
+    @classmethod
+    def deserialize_list(cls,data,wire_format):
+        """Deserialize a list of data, all in the given wire format, into a
+        single array. Returns NotImplemented if this serializer has no batched
+        path, in which case the elements are deserialized one at a time."""
+        return NotImplemented
+    
+    @classmethod
+    def serialize_list(cls,data,wire_format):
+        """Serialize an array holding a list of data into a list in the given
+        wire format. Returns NotImplemented if this serializer has no batched
+        path, in which case the elements are serialized one at a time."""
+        return NotImplemented
+    
+    @classmethod
+    def array_internal_formats(cls):
+        """Returns the internal formats in which a list of this type is
+        deserialized into a single array by deserialize_list()."""
+        return []
+    
+    @classmethod
+    def plain_list_formats(cls):
+        """Returns the wire formats in which serialize_list() also handles
+        plain lists, not only arrays."""
+        return []
+    
+    @classmethod
+    def list_wire_formats(cls):
+        """Returns the wire formats in which a whole list of this type is
+        encoded as a single value by serialize_list() and deserialize_list(),
+        rather than as a list of elements."""
+        return []
+    
+    @classmethod
+    def list_map(cls,wire_format):
+        """Returns a function with the signature of map() used to process the
+        elements of a list in the given wire format one at a time (e.g. on a
+        thread pool), or NotImplemented to process them in order."""
+        return NotImplemented
+    
     #Internal methods 
     
     @classmethod
@@ -262,8 +326,8 @@ class SerializerBase(object):
         return can
     
     @classmethod
-    def _call_deserialize(cls,data,wire_format):
-        data = cls.deserialize(data,wire_format)
+    def _call_deserialize(cls,data,wire_format,out=None):
+        data = _call_with_out(cls,cls.deserialize,out,data,wire_format)
         if data is NotImplemented:
             raise NotImplementedError('deserialize() not implemented in %s' % str(cls))
         return data
@@ -274,6 +338,29 @@ class SerializerBase(object):
         if data is NotImplemented:
             raise NotImplementedError('serialize() not implemented in %s' % str(cls))
         return data
+    
+    @classmethod
+    def _call_deserialize_list(cls,data,wire_format,out=None):
+        if out is not None and not _accepts_out(cls.deserialize_list):
+            return None
+        data = _call_with_out(cls,cls.deserialize_list,out,data,wire_format)
+        if data is NotImplemented:
+            return None
+        return data
+    
+    @classmethod
+    def _call_serialize_list(cls,data,wire_format):
+        data = cls.serialize_list(data,wire_format)
+        if data is NotImplemented:
+            return None
+        return data
+    
+    @classmethod
+    def _call_list_map(cls,wire_format):
+        func = cls.list_map(wire_format)
+        if func is NotImplemented:
+            return None
+        return func
 
 class Translator(object):
     """Base class for translators that can be registered on a Serializer subclass,
@@ -330,6 +417,24 @@ class Translator(object):
         deserialized by this Translator."""
         return None
     
+    @classmethod
+    def sniff_wire_format(cls,parent,data,internal_format):
+        """Returns the wire format of the given data, or None if it cannot be
+        determined. Unlike attempt_deserialize(), the result is remembered for
+        all data with the same affinity key, so later data is deserialized
+        directly in that wire format."""
+        return None
+    
+    @classmethod
+    def affinity_key(cls,parent,data):
+        """Returns a key such that data with equal keys has the same wire
+        format, or None if the wire format should not be remembered. Defaults
+        to the length of the data."""
+        try:
+            return len(data)
+        except TypeError:
+            return None
+    
     @classmethod
     def deserialize(cls,parent,data,wire_format,internal_format):
         """Deserializes the given data into the given internal format, assuming 
@@ -341,6 +446,27 @@ class Translator(object):
         """Serializes the given data from the given internal format to the given
         wire format."""
         raise NotImplementedError('serialize() not implemented in %s' % str(cls))
+    
+    @classmethod
+    def deserialize_list(cls,parent,data,wire_format,internal_format,out=None):
+        """Deserializes a list of data, all in the given wire format, into a
+        single array in the given internal format. Returns None if this
+        Translator cannot deserialize the list in one batch."""
+        return None
+    
+    @classmethod
+    def serialize_list(cls,parent,data,internal_format,wire_format):
+        """Serializes an array holding a list of data in the given internal
+        format into a list in the given wire format. Returns None if this
+        Translator cannot serialize the list in one batch."""
+        return None
+    
+    @classmethod
+    def list_map(cls,parent,wire_format):
+        """Returns a function with the signature of map() used to process the
+        elements of a list in the given wire format one at a time (e.g. on a
+        thread pool), or None to process them in order."""
+        return None
 
 def _parameter_str(param_list, param_dict, parens=True):
     base = ','.join(
@@ -501,6 +627,15 @@ class Serializer(SerializerBase):
     
     #Internal methods 
     
+    @classmethod
+    def _internal_format_for(cls,trans):
+        internal_format = cls.INTERNAL_FORMAT
+        if not internal_format:
+            known_internal_formats = trans.known_internal_formats(cls)
+            if known_internal_formats:
+                internal_format = known_internal_formats[0]
+        return internal_format
+    
     @classmethod
     def _call_choose_wire_format(cls,data,is_list=False):
         return cls.choose_wire_format(data,is_list=is_list)
@@ -557,26 +692,26 @@ class Serializer(SerializerBase):
             return can
     
     @classmethod
-    def _call_deserialize(cls,data,wire_format):
+    def _call_deserialize(cls,data,wire_format,out=None):
         translators = cls.translators()
         if not translators:
-            data = cls.deserialize(data,wire_format)
+            data = _call_with_out(cls,cls.deserialize,out,data,wire_format)
             if data is NotImplemented:
                 raise NotImplementedError('deserialize() not implemented in %s' % str(cls))
             return data
         if wire_format:
             for trans in translators:
                 if trans.can_deserialize(cls, wire_format, cls.INTERNAL_FORMAT):
-                    internal_format = cls.INTERNAL_FORMAT
-                    if not internal_format:
-                        known_internal_formats = trans.known_internal_formats(cls)
-                        if known_internal_formats:
-                            internal_format = known_internal_formats[0]
-                    return trans.deserialize(cls, data, wire_format, internal_format)
+                    internal_format = cls._internal_format_for(trans)
+                    return _call_with_out(cls,trans.deserialize,out,cls,data,wire_format,internal_format)
+        if out is not None:
+            raise SerializationError('%s requires a wire format to deserialize into an output buffer' % cls.get_name())
         for trans in translators:
             if cls.INTERNAL_FORMAT and not _check_format(cls.INTERNAL_FORMAT, trans.known_internal_formats(cls)):
                 continue
-            ret = trans.attempt_deserialize(cls, data, cls.INTERNAL_FORMAT)
+            ret = cls._sniff_deserialize(trans, data)
+            if ret is None:
+                ret = trans.attempt_deserialize(cls, data, cls._internal_format_for(trans))
             if ret is not None:
                 return ret
         if cls.INTERNAL_FORMAT:
@@ -585,6 +720,34 @@ class Serializer(SerializerBase):
             raise SerializationError("%s could not deserialize data from wire format %s" % (cls.get_name(),wire_format))
         
 
+    @classmethod
+    def _sniff_deserialize(cls,trans,data):
+        """Deserializes data in an unknown wire format through the given
+        translator's sniff_wire_format(), using and updating the format
+        affinity cache. Returns None if the wire format cannot be sniffed."""
+        internal_format = cls._internal_format_for(trans)
+        key = trans.affinity_key(cls,data)
+        if key is not None:
+            # Parameterized serializer classes are created on demand, so they
+            # are identified by name
+            key = (cls.get_name(),trans,key)
+            wire_format = _FORMAT_AFFINITY.get(key)
+            if wire_format is not None:
+                try:
+                    return trans.deserialize(cls,data,wire_format,internal_format)
+                except Exception:
+                    _FORMAT_AFFINITY.pop(key,None)
+        
+        wire_format = trans.sniff_wire_format(cls,data,internal_format)
+        if wire_format is None:
+            return None
+        ret = trans.deserialize(cls,data,wire_format,internal_format)
+        if key is not None:
+            if len(_FORMAT_AFFINITY) >= _FORMAT_AFFINITY_SIZE:
+                _FORMAT_AFFINITY.clear()
+            _FORMAT_AFFINITY[key] = wire_format
+        return ret
+    
     @classmethod
     def _call_serialize(cls,data,wire_format):
         translators = cls.translators()
@@ -602,8 +765,40 @@ class Serializer(SerializerBase):
             raise SerializationError("%s could not serialize data from internal format %s to wire format %s" % (cls.get_name(),cls.INTERNAL_FORMAT,wire_format))
         else:
             raise SerializationError("%s could not serialize data to wire format %s" % (cls.get_name(),wire_format))
-        
-        
+    
+    @classmethod
+    def _call_deserialize_list(cls,data,wire_format,out=None):
+        translators = cls.translators()
+        if not translators:
+            return super(Serializer, cls)._call_deserialize_list(data,wire_format,out=out)
+        if not wire_format:
+            return None
+        for trans in translators:
+            if trans.can_deserialize(cls, wire_format, cls.INTERNAL_FORMAT):
+                internal_format = cls._internal_format_for(trans)
+                return trans.deserialize_list(cls, data, wire_format, internal_format, out=out)
+        return None
+    
+    @classmethod
+    def _call_serialize_list(cls,data,wire_format):
+        translators = cls.translators()
+        if not translators:
+            return super(Serializer, cls)._call_serialize_list(data,wire_format)
+        for trans in translators:
+            if trans.can_serialize(cls,data,cls.INTERNAL_FORMAT,wire_format):
+                return trans.serialize_list(cls,data,cls.INTERNAL_FORMAT,wire_format)
+        return None
+    
+    @classmethod
+    def _call_list_map(cls,wire_format):
+        translators = cls.translators()
+        if not translators:
+            return super(Serializer, cls)._call_list_map(wire_format)
+        for trans in translators:
+            if wire_format is None or trans.can_deserialize(cls,wire_format,cls.INTERNAL_FORMAT):
+                return trans.list_map(cls,wire_format)
+        return None
+
 
 class SerializerField(object):
     """Instances of this class wrap Serializers to maintain ordering information
@@ -655,16 +850,17 @@ class _ListSerializer(SerializerBase):
     
     @classmethod
     def is_binary(cls,wire_format):
-        return cls.LIST_TYPE.is_binary(wire_format)
+        return cls.LIST_TYPE._call_is_binary(wire_format)
     
     @classmethod
     def can_deserialize(cls,wire_format):
-        return cls.LIST_TYPE.can_deserialize(wire_format)
+        return cls.LIST_TYPE._call_can_deserialize(wire_format)
     
     @classmethod
     def can_serialize(cls,data,wire_format):
-        data = data or []
-        return all(cls.LIST_TYPE.can_serialize(d,wire_format) for d in data)
+        if data is None:
+            data = []
+        return all(cls.LIST_TYPE._call_can_serialize(d,wire_format) for d in data)
     
     @classmethod
     def _process_data(cls,function,data,format,num_elem=None,level=1,index=[0]):
@@ -673,7 +869,7 @@ class _ListSerializer(SerializerBase):
         if not num_elem:
             return function(data, format)
         processed_data = []
-        for idx, data_elem in enumerate(data or []):
+        for idx, data_elem in enumerate(data if data is not None else []):
             if format is None or isinstance(format,basestring):
                 elem_format = format
             else:
@@ -686,18 +882,68 @@ class _ListSerializer(SerializerBase):
         return processed_data
     
     @classmethod
-    def deserialize(cls,data,wire_format):
+    def _map_data(cls,list_type,function,data,wire_format):
+        """Processes a one-dimensional list with the element type's list_map
+        function, or with _process_data() if it has none."""
+        map_func = None
+        if cls._is_batchable(data,wire_format):
+            map_func = list_type._call_list_map(wire_format)
+        if map_func is None:
+            return cls._process_data(function, data, wire_format)
+        cls._check_batch_length(data)
+        return list(map_func(lambda data_elem: function(data_elem, wire_format), data))
+    
+    @classmethod
+    def _is_batchable(cls,data,wire_format):
+        return (data is not None and len(cls.NUM_ELEM) == 1
+                and (wire_format is None or isinstance(wire_format,basestring)))
+    
+    @classmethod
+    def _check_batch_length(cls,data):
+        if cls.NUM_ELEM[0] is not None and len(data) != cls.NUM_ELEM[0]:
+            raise SerializationError('%s requires exactly %d elements at index %s, got %d' % (
+                                     cls.get_name(), cls.NUM_ELEM[0], (0,), len(data)))
+    
+    @classmethod
+    def deserialize(cls,data,wire_format,out=None):
         list_type = cls.LIST_TYPE
         if cls.INTERNAL_FORMAT == 'entries_required':
             list_type = list_type.required
+        
+        from .serializers import Float, Int
+        as_array = cls.INTERNAL_FORMAT == 'numpy' or (
+                cls.INTERNAL_FORMAT != 'list' and (issubclass(cls.LIST_TYPE,(Float,Int))
+                or cls.LIST_TYPE.INTERNAL_FORMAT in cls.LIST_TYPE.array_internal_formats()))
+        if out is not None and not as_array:
+            raise SerializationError('%s can only deserialize into an output buffer with internal format numpy' % cls.get_name())
+        if cls.INTERNAL_FORMAT == 'numpy' and list_type.INTERNAL_FORMAT is None and list_type.array_internal_formats():
+            # Numpy lists hold elements without an internal format in their
+            # first array format
+            list_type = getattr(list_type,list_type.array_internal_formats()[0])
+        
+        whole_list = wire_format in list_type.list_wire_formats()
+        if (as_array or whole_list) and cls._is_batchable(data,wire_format):
+            if not whole_list:
+                cls._check_batch_length(data)
+            deserialized_data = list_type._call_deserialize_list(data,wire_format,out=out)
+            if deserialized_data is not None:
+                if whole_list:
+                    cls._check_batch_length(deserialized_data)
+                    if not as_array and hasattr(deserialized_data,'tolist'):
+                        deserialized_data = deserialized_data.tolist()
+                return deserialized_data
+        if whole_list:
+            raise SerializationError('%s could not deserialize wire format %s' % (cls.get_name(),wire_format))
+        
         def func(data,wire_format):
             return deserialize(list_type,data,wire_format)
-        deserialized_data = cls._process_data(func, data, wire_format)
+        deserialized_data = cls._map_data(list_type, func, data, wire_format)
         
-        from .serializers import Float, Int
-        if cls.INTERNAL_FORMAT == 'numpy' or (
-                cls.INTERNAL_FORMAT != 'list' and issubclass(cls.LIST_TYPE,(Float,Int))):
+        if as_array:
             import numpy
+            if out is not None:
+                out[...] = deserialized_data
+                return out
             deserialized_data = numpy.array(deserialized_data)
         
         return deserialized_data
@@ -707,9 +953,20 @@ class _ListSerializer(SerializerBase):
         list_type = cls.LIST_TYPE
         if cls.INTERNAL_FORMAT == 'entries_required':
             list_type = list_type.required
+        
+        whole_list = wire_format in list_type.list_wire_formats()
+        if ((whole_list or hasattr(data,'shape') or wire_format in list_type.plain_list_formats())
+                and cls._is_batchable(data,wire_format)):
+            cls._check_batch_length(data)
+            serialized_data = list_type._call_serialize_list(data,wire_format)
+            if serialized_data is not None:
+                return serialized_data
+        if whole_list:
+            raise SerializationError('%s could not serialize data to wire format %s' % (cls.get_name(),wire_format))
+        
         def func(data,wire_format):
             return serialize(list_type,data,wire_format)
-        return cls._process_data(func, data, wire_format, cls.NUM_ELEM, 1)
+        return cls._map_data(list_type, func, data, wire_format)
 
 def _check_num_elem_entry(entry):
     if isinstance(entry, int):
@@ -1210,7 +1467,9 @@ def _binary_convert(serializer_type,wire_format,data,str2bin,file_ok):
                 subformat = wire_format
             new_data[k] = _binary_convert(subtype,subformat,v,str2bin,file_ok)
         return new_data
-    elif issubclass(serializer_type,_ListSerializer):
+    elif issubclass(serializer_type,_ListSerializer) and not (
+            isinstance(data,(basestring,bytearray)) or is_file_like(data)):
+        # Whole lists in a single binary value are converted below
         new_data = []
         for idx, data_item in enumerate(data):
             if isinstance(wire_format,list):
@@ -1422,35 +1681,160 @@ class SerializerRegistry(object):
         return serializer
 
 import struct
+
+_INTERNED_STRINGS = {}
+_INTERNED_STRINGS_SIZE = 4096
+
+def _intern_string(value):
+    interned = _INTERNED_STRINGS.get(value)
+    if interned is None:
+        if len(_INTERNED_STRINGS) >= _INTERNED_STRINGS_SIZE:
+            _INTERNED_STRINGS.clear()
+        interned = _INTERNED_STRINGS[value] = value
+    return interned
+
+class StringTable(object):
+    """Assigns small integer codes to strings that are sent over and over, such
+    as frame names, so that a BinaryWithHeader can send the code instead of the
+    string.
+    
+    The first time the encoding side sends a string, it sends the string along
+    with its newly assigned code; the decoding side records the definition and
+    resolves later codes from it. The codes assigned for encoding and the
+    definitions received for decoding are kept apart, so a process that both
+    sends and receives on a table never mixes its own codes with the remote
+    ones. Strings given to the constructor are known to both sides up front
+    and are never defined in-band.
+    
+    Received definitions must describe one ordered stream: a definition that
+    conflicts with an earlier one (e.g. from a second publisher using the
+    same table name) raises a SerializationError instead of replacing it, so
+    each source needs its own table. Every redefine_every uses of a code, the
+    encoding side sends its definition again, so that a decoder that joins
+    late or misses a definition can resolve the code afterwards.
+    
+    Named tables are shared through StringTable.get(name), which is how
+    serializer parameters (e.g. Pose('frame',frame_table='tf')) refer to
+    them."""
+    MAX_CODES = 65536
+    REDEFINE_EVERY = 256
+    _tables = {}
+    
+    @classmethod
+    def get(cls,name):
+        """Returns the table registered under the given name, creating it if
+        necessary."""
+        table = cls._tables.get(name)
+        if table is None:
+            table = cls._tables[name] = cls()
+        return table
+    
+    def __init__(self,strings=(),redefine_every=None):
+        self.redefine_every = redefine_every or self.REDEFINE_EVERY
+        self._preset = []
+        for value in strings:
+            value = _intern_string(value)
+            if value not in self._preset:
+                self._preset.append(value)
+        self.clear()
+    
+    def __len__(self):
+        return len(self._codes)
+    
+    def clear(self):
+        """Forgets all codes assigned and received, except the preset ones,
+        e.g. when the remote side restarts."""
+        self._codes = dict((value,code) for code, value in enumerate(self._preset))
+        self._uses = [0] * len(self._preset)
+        self._strings = dict(enumerate(self._preset))
+    
+    def encode(self,value):
+        """Returns (code, define) for the given string, assigning a new code
+        if necessary, or (None, False) if the table is full. If define is
+        true, the definition of the code must be sent along with it."""
+        code = self._codes.get(value)
+        if code is None:
+            if len(self._codes) >= self.MAX_CODES:
+                return None, False
+            code = self._codes[_intern_string(value)] = len(self._codes)
+            self._uses.append(0)
+        uses = self._uses[code]
+        self._uses[code] = uses + 1
+        return code, code >= len(self._preset) and uses % self.redefine_every == 0
+    
+    def decode(self,code):
+        try:
+            return self._strings[code]
+        except KeyError:
+            raise SerializationError('Unknown string code %d; its definition was not received' % code)
+    
+    def define(self,code,value):
+        """Records a received definition. Raises a SerializationError if the
+        code is already defined as a different string."""
+        existing = self._strings.get(code)
+        if existing is None:
+            self._strings[code] = _intern_string(value)
+        elif existing != value:
+            raise SerializationError('String code %d is already defined as %r, not %r; '
+                                     'each source needs its own table' % (code, existing, value))
+
 class BinaryWithHeader(object):
+    """A header of typed fields (int, float, or str) in front of a binary
+    payload.
+    
+    The fields are compiled once on construction: runs of consecutive int and
+    float fields are packed and unpacked with a single struct.Struct, and
+    strings are stored as Pascal strings. unpack_from() parses the header in
+    place and returns the offset of the payload instead of copying it.
+    
+    Keyword arguments:
+        intern_strings: If true, unpacked strings are interned, so that
+            repeated values (e.g. frame names) share a single object.
+        string_table: A StringTable used to send repeated strings as codes.
+            Coded strings are marked with a negative length byte, so both
+            sides must use a table."""
     _TYPES = {int: 'i', float: 'd'}
+    # Length byte, then code, for strings sent through a StringTable
+    _STRING_CODE = struct.Struct('=bH')
+    _STRING_REF = -1
+    _STRING_DEF = -2
     
     @classmethod
     def _get_types(cls):
         return set(cls._TYPES.keys() + [basestring])
     
-    @classmethod
-    def _pack_field(cls,field,value):
-        if issubclass(field,basestring):
-            value = str(value)
-            l = len(value)
-            return struct.pack(str(l+1) + 'p', value)
-        else:
-            return struct.pack(cls._TYPES[field],value)
-    
-    @classmethod
-    def _unpack_field(cls,field,b):
-        if issubclass(field,basestring):
-            l = struct.unpack('b',str(b[0:1]))[0]
-            if l == 0:
-                return '', b[1:]
-            else:
-                value = ''.join(struct.unpack(str(l)+'c',str(b[1:l+1])))
-                return value, b[l+1:]
-        else:
-            size = struct.calcsize(cls._TYPES[field])
-            value = struct.unpack(cls._TYPES[field],str(b[:size]))[0]
-            return value, b[size:]
+    def _pack_string(self,value):
+        value = str(value)
+        pascal = struct.pack(str(len(value)+1) + 'p', value)
+        if self.string_table is not None:
+            code, define = self.string_table.encode(value)
+            if define:
+                return self._STRING_CODE.pack(self._STRING_DEF,code) + pascal
+            elif code is not None:
+                return self._STRING_CODE.pack(self._STRING_REF,code)
+        return pascal
+    
+    def _unpack_string(self,b,offset):
+        l = struct.unpack_from('b',b,offset)[0]
+        if l < 0:
+            if self.string_table is None or l not in (self._STRING_REF,self._STRING_DEF):
+                raise struct.error('Invalid Pascal string length %d' % l)
+            code = self._STRING_CODE.unpack_from(b,offset)[1]
+            offset += self._STRING_CODE.size
+            if l == self._STRING_REF:
+                return self.string_table.decode(code), offset
+            value, offset = self._unpack_string(b,offset)
+            self.string_table.define(code,value)
+            return self.string_table.decode(code), offset
+        offset += 1
+        if l == 0:
+            return '', offset
+        if offset + l > len(b):
+            raise struct.error('Pascal string runs past the end of the buffer')
+        value = str(b[offset:offset+l])
+        if self.intern_strings:
+            value = _intern_string(value)
+        return value, offset + l
     
     def __init__(self,*args,**kwargs):
         if isinstance(args[0], tuple):
@@ -1470,34 +1854,75 @@ class BinaryWithHeader(object):
         for field in self.fields:
             if not issubclass(field,tuple(self._get_types())):
                 raise TypeError('Unknown field type %s' % field)
+        
+        self._segments = self._compile(self.fields)
+        self.intern_strings = kwargs.get('intern_strings',False)
+        self.string_table = kwargs.get('string_table')
+    
+    @classmethod
+    def _compile(cls,fields):
+        # Each segment is either a struct.Struct covering a run of numeric
+        # fields, or None for a single string field. '=' keeps native byte
+        # order without alignment padding, which matches packing the fields
+        # one at a time.
+        segments = []
+        codes = ''
+        for field in fields:
+            if issubclass(field,basestring):
+                if codes:
+                    segments.append(struct.Struct('=' + codes))
+                    codes = ''
+                segments.append(None)
+            else:
+                codes += cls._TYPES[field]
+        if codes:
+            segments.append(struct.Struct('=' + codes))
+        return segments
     
     def pack(self,*args,**kwargs):
-        b = bytearray()
         if kwargs:
             if not self.field_names:
                 raise TypeError("Can't pack fields by name without field_names set!")
             elif len(args) != 1:
                 raise ValueError("Payload argument is missing!")
-            for field_name, field in zip(self.field_names,self.fields):
-                value = kwargs.get(field_name,field())
-                b.extend(self._pack_field(field,value))
+            values = [kwargs.get(field_name,field()) for field_name, field in zip(self.field_names,self.fields)]
         else:
             if len(args) != len(self.fields) + 1:
                 raise ValueError('pack requires %d fields + binary data' % len(self.fields))
-            for field, value in zip(self.fields,args[:-1]):
-                b.extend(self._pack_field(field,value))
+            values = args[:-1]
+        
+        b = bytearray()
+        idx = 0
+        for segment in self._segments:
+            if segment is None:
+                b.extend(self._pack_string(values[idx]))
+                idx += 1
+            else:
+                n = len(segment.format) - 1
+                b.extend(segment.pack(*values[idx:idx+n]))
+                idx += n
         
         b.extend(args[-1])
         
         return b
     
-    def unpack(self,b):
+    def unpack_from(self,b,offset=0):
+        """Parses the header from the buffer b starting at offset, returning
+        the field values and the offset of the payload."""
         values = []
-        for field in self.fields:
-            value, b = self._unpack_field(field,b)
-            values.append(value)
+        for segment in self._segments:
+            if segment is None:
+                value, offset = self._unpack_string(b,offset)
+                values.append(value)
+            else:
+                values.extend(segment.unpack_from(b,offset))
+                offset += segment.size
         
         if self.field_names:
             values = dict(zip(self.field_names,values))
         
-        return values, b
+        return values, offset
+    
+    def unpack(self,b):
+        values, offset = self.unpack_from(b)
+        return values, b[offset:]
@@ -5,6 +5,8 @@ from .serializer import _get_list_serializer
 import sys
 import time, datetime
 import json
+import re
+import numbers
 
 _NUMPY = False
 try:
@@ -17,6 +19,26 @@ from cStringIO import StringIO
 
 from .util import iso8601
 
+def _load_npy(data):
+    """Returns the array stored in .npy-formatted binary data as a view of
+    the data, without copying the payload."""
+    sio = StringIO(data)
+    version = numpy.lib.format.read_magic(sio)
+    if version != (1,0):
+        return numpy.load(StringIO(data))
+    shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(sio)
+    if dtype.hasobject:
+        return numpy.load(StringIO(data))
+    count = int(numpy.prod(shape))
+    mat = numpy.frombuffer(data, dtype=dtype, count=count, offset=sio.tell())
+    return mat.reshape(shape, order='F' if fortran_order else 'C')
+
+def _copy_into(out, mat):
+    if out.size != mat.size:
+        raise SerializationError('Output buffer has size %d, but the data has size %d!' % (out.size, mat.size))
+    out[...] = mat.reshape(out.shape)
+    return out
+
 class PrimitiveTypeSerializer(Serializer):
     PRIMITIVE_TYPE = None
     
@@ -76,28 +98,159 @@ class JSON(Serializer):
     def serialize(cls,data,wire_format):
         return json.dumps(data)
 
+# Nanoseconds per unit of the numeric Timestamp formats
+_NS_PER_UNIT = {'s': 10**9, 'ms': 10**6, 'ns': 1}
+_EPOCH = datetime.datetime(1970,1,1)
+
+def _numbers_to_ns(values, unit):
+    """Converts an array of numbers in the given unit to int64 nanoseconds,
+    splitting floats into whole and fractional parts to keep precision."""
+    scale = _NS_PER_UNIT[unit]
+    if values.dtype.kind in 'iu':
+        return values.astype(numpy.int64) * scale
+    values = values.astype(numpy.float64)
+    whole = numpy.floor(values)
+    return whole.astype(numpy.int64) * scale + numpy.round((values - whole) * scale).astype(numpy.int64)
+
+def _ns_to_numbers(ns, unit):
+    scale = _NS_PER_UNIT[unit]
+    if scale == 1:
+        return ns
+    return (ns // scale) + (ns % scale) / float(scale)
+
+def _iso_to_ns(data):
+    """Converts a list of ISO 8601 strings to int64 nanoseconds. Lists of UTC
+    dates are parsed by numpy in one call."""
+    if all(s[-1:] == 'Z' for s in data):
+        try:
+            return numpy.array([s[:-1] for s in data], dtype='datetime64[ns]').view(numpy.int64)
+        except ValueError:
+            pass
+    return numpy.array([_datetime_to_ns(iso8601.parse_date(s)) for s in data], dtype=numpy.int64)
+
+def _datetime_to_ns(dt):
+    offset = dt.utcoffset()
+    if offset is None:
+        # Naive dates are local time, as in Timestamp.deserialize
+        seconds = int(time.mktime(dt.timetuple()))
+    else:
+        delta = dt.replace(tzinfo=None) - offset - _EPOCH
+        seconds = delta.days * 86400 + delta.seconds
+    return seconds * 10**9 + dt.microsecond * 1000
+
+def _ns_to_datetime(ns):
+    return datetime.datetime.fromtimestamp(ns // 10**9).replace(microsecond=(ns % 10**9) // 1000)
+
+def _ns_to_utc_datetime(ns):
+    return _EPOCH + datetime.timedelta(microseconds=ns // 1000)
+
+def _ns_to_iso(ns):
+    unit = 'us' if not (ns % 1000).any() else 'ns'
+    return numpy.datetime_as_string(ns.view('datetime64[ns]'), unit=unit, timezone='UTC')
+
+def _encode_dod(ns):
+    from .util import dod
+    return dod.encode(ns)
+
+def _decode_dod(serializer,data):
+    from .util import dod
+    try:
+        return dod.decode(data)
+    except dod.DODError as e:
+        raise SerializationError('%s could not decode dod data: %s' % (serializer.get_name(), e))
+
+# Numbers as written in the s, ms and ns wire formats
+_NUMBER_REGEX = re.compile(r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+
+# Wire formats of unlabeled time data, learned by serializer class name and
+# data type, so that each kind of field is only sniffed once
+_LEARNED_WIRE_FORMATS = {}
+_LEARNED_WIRE_FORMATS_SIZE = 1024
+
+def _sniff_time_format(data):
+    """Returns 's' for numbers and numeric strings, 'iso' for strings that
+    start like an ISO 8601 date, and None otherwise."""
+    if isinstance(data, numbers.Real):
+        return 's'
+    if isinstance(data, basestring):
+        if _NUMBER_REGEX.match(data):
+            return 's'
+        if data[:4].isdigit():
+            return 'iso'
+    return None
+
+def _learn_time_format(serializer, data, wire_format=None):
+    """Returns the learned wire format for unlabeled data, sniffing it if
+    there is none or if the learned format (given as wire_format) failed."""
+    key = (serializer.__name__, type(data))
+    learned = _LEARNED_WIRE_FORMATS.get(key)
+    if learned is not None and learned != wire_format:
+        return learned
+    sniffed = _sniff_time_format(data)
+    if sniffed is None or sniffed == wire_format:
+        raise SerializationError('Unknown %s data %r' % (serializer.get_name(), data))
+    if len(_LEARNED_WIRE_FORMATS) >= _LEARNED_WIRE_FORMATS_SIZE:
+        _LEARNED_WIRE_FORMATS.clear()
+    _LEARNED_WIRE_FORMATS[key] = sniffed
+    return sniffed
+
 class Timestamp(Serializer):
+    # Internal formats that hold lists of timestamps as a single array:
+    # datetime64[ns] values, or int64 nanoseconds since the epoch
+    _ARRAY_INTERNAL_FORMATS = ['datetime64','int_ns']
+    
     @classmethod
     def known_wire_formats(cls):
-        return ['iso','s','ms','ns']
+        return ['iso','s','ms','ns','dod']
     
     @classmethod
     def known_internal_formats(cls):
-        return ['datetime','iso','s','ms','ns']
+        return ['datetime','iso','s','ms','ns','datetime64','int_ns']
+    
+    @classmethod
+    def is_binary(cls,wire_format):
+        return wire_format == 'dod'
+    
+    @classmethod
+    def array_internal_formats(cls):
+        return cls._ARRAY_INTERNAL_FORMATS
+    
+    @classmethod
+    def plain_list_formats(cls):
+        # Lists of datetimes are formatted in one batch
+        return ['iso']
+    
+    @classmethod
+    def list_wire_formats(cls):
+        # Delta-of-delta encoded int64 nanoseconds, see util.dod
+        return ['dod']
+    
+    @classmethod
+    def can_deserialize(cls,wire_format):
+        return wire_format in cls.known_wire_formats()
+    
+    @classmethod
+    def can_serialize(cls,data,wire_format):
+        return wire_format in cls.known_wire_formats()
     
     @classmethod
     def deserialize(cls,data,wire_format):
+        if wire_format in cls.list_wire_formats():
+            raise SerializationError('%s is a list-only wire format' % wire_format)
         if wire_format is None:
+            wire_format = _LEARNED_WIRE_FORMATS.get((cls.__name__,type(data))) or _learn_time_format(cls,data)
             try:
-                seconds = float(data)
-                dt = datetime.datetime.fromtimestamp(seconds)
-            except:
-                try:
-                    dt = iso8601.parse_date(data)
-                    seconds = time.mktime(dt.timetuple())+1e-6*dt.microsecond
-                except:
-                    raise SerializationError('Unknown Timestamp data %s' % data)
-        elif wire_format == 'iso':
+                return cls._deserialize(data,wire_format)
+            except (ValueError, TypeError, iso8601.ParseError):
+                # The data changed format since it was learned
+                return cls._deserialize(data,_learn_time_format(cls,data,wire_format))
+        return cls._deserialize(data,wire_format)
+    
+    @classmethod
+    def _deserialize(cls,data,wire_format):
+        if cls.INTERNAL_FORMAT in cls._ARRAY_INTERNAL_FORMATS:
+            return cls.deserialize_list([data],wire_format)[0]
+        if wire_format == 'iso':
             if cls.INTERNAL_FORMAT == 'iso':
                 return data
             dt = iso8601.parse_date(data)
@@ -108,34 +261,41 @@ class Timestamp(Serializer):
             elif wire_format == 'ms':
                 seconds = float(data) / 1e3
             elif wire_format == 'ns':
-                seconds = float(data) / 1e6
+                seconds = float(data) / 1e9
             else:
                 raise SerializationError('Unknown Timestamp wire format %s' % wire_format)
             dt = datetime.datetime.fromtimestamp(seconds)
         
         if cls.INTERNAL_FORMAT == 'datetime':
             return dt
-        elif cls.INTERNAL_FORMAT == 's':
+        elif cls.INTERNAL_FORMAT in ['s',None]:
             return seconds
         elif cls.INTERNAL_FORMAT == 'ms':
             return seconds * 1e3
         elif cls.INTERNAL_FORMAT == 'ns':
-            return seconds * 1e6
+            return seconds * 1e9
 
     @classmethod
     def serialize(cls,data,wire_format):
+        if wire_format in cls.list_wire_formats():
+            raise SerializationError('%s is a list-only wire format' % wire_format)
+        if cls.INTERNAL_FORMAT in cls._ARRAY_INTERNAL_FORMATS:
+            return cls.serialize_list(numpy.asarray([data]),wire_format)[0]
         if cls.INTERNAL_FORMAT == 'iso' or isinstance(data,basestring):
             if wire_format == 'iso':
                 return data
             dt = iso8601.parse_date(data)
             seconds = time.mktime(dt.timetuple())+1e-6*dt.microsecond
+        elif isinstance(data,datetime.datetime):
+            dt = data
+            seconds = time.mktime(dt.timetuple())+1e-6*dt.microsecond
         else:
-            if cls.INTERNAL_FORMAT == 's':
+            if cls.INTERNAL_FORMAT in ['s',None]:
                 seconds = float(data)
             elif cls.INTERNAL_FORMAT == 'ms':
                 seconds = float(data) / 1e3
             elif cls.INTERNAL_FORMAT == 'ns':
-                seconds = float(data) / 1e6
+                seconds = float(data) / 1e9
             dt = datetime.datetime.fromtimestamp(seconds)
         
         if wire_format == 'iso':
@@ -145,25 +305,113 @@ class Timestamp(Serializer):
         elif wire_format == 'ms':
             return seconds * 1e3
         elif wire_format == 'ns':
-            return seconds * 1e6
+            return seconds * 1e9
+    
+    @classmethod
+    def deserialize_list(cls,data,wire_format):
+        if not _NUMPY:
+            return NotImplemented
+        if wire_format == 'dod':
+            ns = _decode_dod(cls,data)
+            if cls.INTERNAL_FORMAT == 'datetime':
+                return [_ns_to_datetime(t) for t in ns.tolist()]
+            elif cls.INTERNAL_FORMAT == 'iso':
+                return _ns_to_iso(ns).tolist()
+        elif cls.INTERNAL_FORMAT not in cls._ARRAY_INTERNAL_FORMATS + [None,'s','ms','ns']:
+            return NotImplemented
+        elif wire_format is None:
+            if not len(data):
+                return cls.deserialize_list(data,'s')
+            wire_format = _learn_time_format(cls,data[0])
+            try:
+                return cls.deserialize_list(data,wire_format)
+            except (ValueError, TypeError, iso8601.ParseError):
+                return cls.deserialize_list(data,_learn_time_format(cls,data[0],wire_format))
+        elif wire_format == 'iso':
+            ns = _iso_to_ns(data)
+        elif wire_format in _NS_PER_UNIT:
+            values = numpy.asarray(data)
+            if values.dtype.kind not in 'iuf':
+                values = values.astype(numpy.float64)
+            ns = _numbers_to_ns(values,wire_format)
+        else:
+            raise SerializationError('Unknown Timestamp wire format %s' % wire_format)
+        
+        if cls.INTERNAL_FORMAT == 'datetime64':
+            return ns.view('datetime64[ns]')
+        elif cls.INTERNAL_FORMAT == 'int_ns':
+            return ns
+        return _ns_to_numbers(ns,cls.INTERNAL_FORMAT or 's')
+    
+    @classmethod
+    def serialize_list(cls,data,wire_format):
+        if wire_format == 'iso' and not hasattr(data,'shape'):
+            # Lists are written in UTC, whatever their container
+            if cls.INTERNAL_FORMAT in ['datetime',None] and all(isinstance(dt,datetime.datetime) for dt in data):
+                return iso8601.print_dates([_ns_to_utc_datetime(_datetime_to_ns(dt)) for dt in data], 'UTC')
+            if not all(isinstance(v,numbers.Number) for v in data):
+                return NotImplemented
+        if not _NUMPY:
+            return NotImplemented
+        if cls.INTERNAL_FORMAT == 'datetime' and wire_format == 'dod':
+            ns = numpy.array([_datetime_to_ns(dt) for dt in data], dtype=numpy.int64)
+        elif cls.INTERNAL_FORMAT == 'iso' and wire_format == 'dod':
+            ns = _iso_to_ns(data)
+        elif getattr(data,'dtype',None) is not None and data.dtype.kind == 'M':
+            ns = data.astype('datetime64[ns]').view(numpy.int64)
+        elif cls.INTERNAL_FORMAT == 'int_ns':
+            ns = numpy.asarray(data).astype(numpy.int64)
+        elif cls.INTERNAL_FORMAT in _NS_PER_UNIT or cls.INTERNAL_FORMAT is None:
+            # Numbers without an internal format are seconds, as in serialize()
+            ns = _numbers_to_ns(numpy.asarray(data),cls.INTERNAL_FORMAT or 's')
+        else:
+            return NotImplemented
+        
+        if wire_format == 'dod':
+            return _encode_dod(ns)
+        elif wire_format == 'iso':
+            return _ns_to_iso(ns).tolist()
+        elif wire_format in _NS_PER_UNIT:
+            return _ns_to_numbers(ns,wire_format).tolist()
+        return NotImplemented
 
 class Duration(Serializer):
     @classmethod
     def known_wire_formats(cls):
-        return ['s','ms','ns']
+        return ['s','ms','ns','dod']
         
     @classmethod
     def known_internal_formats(cls):
         return ['s','ms','ns']
+    
+    @classmethod
+    def can_deserialize(cls,wire_format):
+        return wire_format in cls.known_wire_formats()
+    
+    @classmethod
+    def can_serialize(cls,data,wire_format):
+        return wire_format in cls.known_wire_formats()
+    
+    @classmethod
+    def is_binary(cls,wire_format):
+        return wire_format == 'dod'
+    
+    @classmethod
+    def list_wire_formats(cls):
+        return ['dod']
         
     @classmethod
     def deserialize(cls,data,wire_format):
+        if wire_format in cls.list_wire_formats():
+            raise SerializationError('%s is a list-only wire format' % wire_format)
+        if wire_format is None and _sniff_time_format(data) != 's':
+            raise SerializationError('Unknown Duration data %r' % (data,))
         if wire_format == 's' or wire_format is None:
             seconds = float(data)
         elif wire_format == 'ms':
             seconds = float(data) / 1e3
         elif wire_format == 'ns':
-            seconds = float(data) / 1e6
+            seconds = float(data) / 1e9
         else:
             raise SerializationError('Unknown Duration wire format %s' % wire_format)
         
@@ -172,16 +420,18 @@ class Duration(Serializer):
         elif cls.INTERNAL_FORMAT == 'ms':
             return seconds * 1e3
         elif cls.INTERNAL_FORMAT == 'ns':
-            return seconds * 1e6
+            return seconds * 1e9
 
     @classmethod
     def serialize(cls,data,wire_format):
+        if wire_format in cls.list_wire_formats():
+            raise SerializationError('%s is a list-only wire format' % wire_format)
         if cls.INTERNAL_FORMAT == 's' or cls.INTERNAL_FORMAT is None:
             seconds = float(data)
         elif cls.INTERNAL_FORMAT == 'ms':
             seconds = float(data) / 1e3
         elif cls.INTERNAL_FORMAT == 'ns':
-            seconds = float(data) / 1e6
+            seconds = float(data) / 1e9
         else:
             raise SerializationError('Unknown Duration wire format %s' % wire_format)
         
@@ -190,7 +440,19 @@ class Duration(Serializer):
         elif wire_format == 'ms':
             return seconds * 1e3
         elif wire_format == 'ns':
-            return seconds * 1e6
+            return seconds * 1e9
+    
+    @classmethod
+    def deserialize_list(cls,data,wire_format):
+        if not _NUMPY or wire_format != 'dod':
+            return NotImplemented
+        return _ns_to_numbers(_decode_dod(cls,data),cls.INTERNAL_FORMAT or 's')
+    
+    @classmethod
+    def serialize_list(cls,data,wire_format):
+        if not _NUMPY or wire_format != 'dod':
+            return NotImplemented
+        return _encode_dod(_numbers_to_ns(numpy.asarray(data),cls.INTERNAL_FORMAT or 's'))
 
 class Rotation(Serializer):
     pass
@@ -201,8 +463,42 @@ class Pose(Serializer):
 class Transform(Serializer):
     pass
 
+# Image parameters and their allowed ranges
+_IMAGE_PARAMETERS = {'quality': (0,100),
+                     'png_level': (0,9),
+                     'threads': (1,1024),
+                     'reduce': (1,8)}
+
+def _parse_roi(value):
+    if isinstance(value,basestring):
+        value = value.split(':')
+    try:
+        roi = tuple(int(v) for v in value)
+    except (TypeError, ValueError):
+        roi = ()
+    if len(roi) != 4 or min(roi) < 0:
+        raise ValueError("Image roi must be x:y:width:height!")
+    return roi
+
 class Image(Serializer):
-    pass
+    @classmethod
+    def _PARAMETER_CHECK(cls,*args,**kwargs):
+        if args:
+            raise ValueError("Image parameters must be given by name!")
+        for name, value in kwargs.items():
+            if name == 'roi':
+                kwargs[name] = ':'.join(str(v) for v in _parse_roi(value))
+                continue
+            if name not in _IMAGE_PARAMETERS:
+                raise ValueError("Unknown Image parameter %s!" % name)
+            low, high = _IMAGE_PARAMETERS[name]
+            value = int(value)
+            if not low <= value <= high:
+                raise ValueError("Image parameter %s must be between %d and %d!" % (name, low, high))
+            if name == 'reduce' and value not in (1,2,4,8):
+                raise ValueError("Image parameter reduce must be 1, 2, 4, or 8!")
+            kwargs[name] = value
+        return args, kwargs
 
 class Vector(Serializer):
     @classmethod
@@ -221,15 +517,21 @@ class Vector(Serializer):
         return ['list','numpy']
     
     @classmethod
-    def deserialize(cls, data, wire_format):
+    def deserialize(cls, data, wire_format, out=None):
         if wire_format == 'numpy':
-            mat = numpy.load(StringIO(data))
+            mat = _load_npy(data)
         else:
-            mat = numpy.array(data)
+            mat = numpy.asarray(data)
         dim = cls.PARAMETER_LIST[0] if cls.PARAMETER_LIST else None
         if dim and mat.size != dim:
             raise SerializationError('This vector must have dimension %d, but it is %d!' % (dim, mat.size))
         
+        if out is not None:
+            return _copy_into(out, mat)
+        
+        if wire_format == 'numpy' and not mat.flags.writeable:
+            mat = mat.copy()
+        
         if cls.INTERNAL_FORMAT in ['row','rowmatrix']:
             mat = mat.reshape((1,mat.size))
         elif cls.INTERNAL_FORMAT in ['col','column','colmatrix','columnmatrix']:
@@ -275,16 +577,23 @@ class Matrix(Serializer):
         return ['list','numpy']
     
     @classmethod
-    def deserialize(cls, data, wire_format):
+    def deserialize(cls, data, wire_format, out=None):
         if wire_format == 'numpy':
-            mat = numpy.load(StringIO(data))
+            mat = _load_npy(data)
         else:
-            mat = numpy.array(data)
+            mat = numpy.asarray(data)
         rows,cols = cls.PARAMETER_LIST if cls.PARAMETER_LIST else (None,None)
         if rows and mat.shape[0] != rows:
             raise SerializationError('This matrix must have %d rows, but it has shape %s!' % (rows, mat.shape))
         if cols and mat.shape[1] != cols:
             raise SerializationError('This matrix must have %d columns, but it has shape %s!' % (cols, mat.shape))
+        if out is not None:
+            if out.shape != mat.shape:
+                raise SerializationError('Output buffer has shape %s, but the matrix has shape %s!' % (out.shape, mat.shape))
+            out[...] = mat
+            return out
+        if wire_format == 'numpy' and not mat.flags.writeable:
+            mat = mat.copy()
         return mat
     
     @classmethod
@@ -326,30 +635,23 @@ class Matrix(Serializer):
             raise ValueError("Matrix parameters must be rows and columns!")
 
 class PointCloud(Serializer):
-
     @classmethod
-    def known_formats(cls):
-        return []
-    
-    @classmethod
-    def is_binary(cls,wire_format):
-        return True
-        return format == 'pcd.binary' or format == 'raw'
-    
-    @classmethod
-    def deserialize(cls,data,wire_format):
-        if cls.deserialized_format in ['raw', wire_format]:
-            return data
-        else:
-            raise NotImplementedError()
-
-    @classmethod
-    def serialize(cls,data,wire_format):
-        if is_file_like(data):
-            #TODO: figure out format, convert if necessary
-            return data
-        else:
-            raise NotImplementedError()
+    def _PARAMETER_CHECK(cls,*args,**kwargs):
+        if args:
+            raise ValueError("PointCloud parameters must be given by name!")
+        for name, value in kwargs.items():
+            if name == 'voxel':
+                value = float(value)
+                if not value > 0:
+                    raise ValueError("PointCloud voxel size must be positive!")
+            elif name == 'stride':
+                value = int(value)
+                if value < 1:
+                    raise ValueError("PointCloud stride must be at least 1!")
+            else:
+                raise ValueError("Unknown PointCloud parameter %s!" % name)
+            kwargs[name] = value
+        return args, kwargs
 
 if not SerializerRegistry._builtins:
     SerializerRegistry._register_builtins(Bool,Int,Float,String,Blob,Timestamp,Duration,Pose,Transform,Vector,Matrix,Image,PointCloud)
@@ -0,0 +1,245 @@
+from __future__ import absolute_import
+
+import collections
+import numpy as np
+
+from .translators import transformations
+from .translators.geom_numpy import pose_to_pq
+
+class TransformLookupError(Exception):
+    pass
+
+class _Edge(object):
+    """Time-sorted transforms between one pair of frames, stored as an
+    array of stamps and an (N,7) array of (x,y,z,qx,qy,qz,qw) rows."""
+    def __init__(self):
+        self.stamps = np.empty((16,), dtype=np.float64)
+        self.pq = np.empty((16,7), dtype=np.float64)
+        self.size = 0
+        self.static = None
+
+    def insert(self,stamp,pq):
+        if stamp is None:
+            if self.size:
+                raise TransformLookupError('Static transform added to a pair of frames with stamped transforms')
+            self.static = pq
+            return
+        if self.static is not None:
+            raise TransformLookupError('Stamped transform added to a pair of frames with a static transform')
+        n = self.size
+        if n == len(self.stamps):
+            self.stamps = np.resize(self.stamps,(2*n,))
+            self.pq = np.resize(self.pq,(2*n,7))
+        if n == 0 or stamp > self.stamps[n-1]:
+            idx = n
+        else:
+            idx = int(np.searchsorted(self.stamps[:n],stamp))
+            if idx < n and self.stamps[idx] == stamp:
+                self.pq[idx] = pq
+                return
+            self.stamps[idx+1:n+1] = self.stamps[idx:n].copy()
+            self.pq[idx+1:n+1] = self.pq[idx:n].copy()
+        self.stamps[idx] = stamp
+        self.pq[idx] = pq
+        self.size = n + 1
+
+    def prune(self,oldest):
+        n = self.size
+        idx = int(np.searchsorted(self.stamps[:n],oldest))
+        # Keep one sample before the cutoff so lookups at the cutoff
+        # can still interpolate
+        idx = max(idx-1,0)
+        if idx:
+            self.stamps[:n-idx] = self.stamps[idx:n].copy()
+            self.pq[:n-idx] = self.pq[idx:n].copy()
+            self.size = n - idx
+
+    def latest(self):
+        if self.static is not None or not self.size:
+            return None
+        return self.stamps[self.size-1]
+
+    def lookup(self,stamps):
+        """Returns the (N,7) interpolated values at the given stamps, or the
+        latest value for stamps that are None."""
+        if self.static is not None:
+            return np.tile(self.static,(len(stamps),1))
+        n = self.size
+        if not n:
+            raise TransformLookupError('No data')
+        times = self.stamps[:n]
+        stamps = np.where(np.isnan(stamps),times[n-1],stamps)
+        if stamps.min() < times[0] or stamps.max() > times[n-1]:
+            raise TransformLookupError('Requested time is outside of the buffered range [%f, %f]' % (times[0],times[n-1]))
+        if n == 1:
+            return np.tile(self.pq[0],(len(stamps),1))
+        hi = np.clip(np.searchsorted(times,stamps),1,n-1)
+        lo = hi - 1
+        fraction = (stamps - times[lo]) / (times[hi] - times[lo])
+        pq0 = self.pq[lo]
+        pq1 = self.pq[hi]
+        pq = np.empty((len(stamps),7))
+        pq[:,:3] = pq0[:,:3] + fraction[:,np.newaxis] * (pq1[:,:3] - pq0[:,:3])
+        pq[:,3:] = transformations.quaternion_slerp_array(pq0[:,3:],pq1[:,3:],fraction)
+        return pq
+
+def _invert_pq(pq):
+    q = pq[:,3:] * (-1,-1,-1,1)
+    R = transformations.quaternion_matrix_array(q)[:,0:3,0:3]
+    p = -np.einsum('nij,nj->ni',R,pq[:,:3])
+    return np.hstack((p,q))
+
+def _compose_pq(pq1,pq0):
+    """Returns the transform that applies pq0 and then pq1."""
+    R1 = transformations.quaternion_matrix_array(pq1[:,3:])[:,0:3,0:3]
+    p = np.einsum('nij,nj->ni',R1,pq0[:,:3]) + pq1[:,:3]
+    q = transformations.quaternion_multiply_array(pq1[:,3:],pq0[:,3:])
+    return np.hstack((p,q))
+
+class TransformBuffer(object):
+    """A time-indexed buffer of transforms between frames.
+
+    Transforms are added as the dicts produced by deserializing
+    Transform('stamped','frame'), with keys stamp, from_frame, to_frame, and
+    value. The value maps coordinates in from_frame to coordinates in
+    to_frame. Transforms with a stamp of None are static and valid at all
+    times. A pair of frames holds either a static transform or stamped
+    transforms; mixing the two raises a TransformLookupError.
+
+    lookup() finds the transform between any two connected frames at a
+    given time, interpolating each link with linear interpolation of the
+    position and slerp of the rotation, and composing the links along the
+    chain of intermediate frames. Chains are cached until a new pair of
+    frames is connected.
+
+    Parameters:
+        cache_time: The duration of data kept for each pair of frames,
+            relative to its latest stamp. None keeps everything."""
+
+    def __init__(self,cache_time=10.0):
+        self.cache_time = cache_time
+        self._edges = {}
+        self._neighbors = collections.defaultdict(set)
+        self._chains = {}
+
+    def clear(self):
+        self._edges.clear()
+        self._neighbors.clear()
+        self._chains.clear()
+
+    def add(self,transform,internal_format=None):
+        """Adds a deserialized stamped and framed transform. The internal
+        format of its value can be given to skip inferring it."""
+        from_frame = transform['from_frame']
+        to_frame = transform['to_frame']
+        if from_frame == to_frame:
+            raise TransformLookupError('Transform from frame %s to itself' % from_frame)
+        pq = pose_to_pq(transform['value'],internal_format)
+
+        key = (from_frame,to_frame)
+        edge = self._edges.get(key)
+        if edge is None:
+            if (to_frame,from_frame) in self._edges:
+                key = (to_frame,from_frame)
+                edge = self._edges[key]
+                pq = _invert_pq(pq[np.newaxis,:])[0]
+            else:
+                edge = self._edges[key] = _Edge()
+                self._neighbors[from_frame].add(to_frame)
+                self._neighbors[to_frame].add(from_frame)
+                self._chains.clear()
+
+        stamp = transform.get('stamp')
+        edge.insert(stamp,pq)
+        if stamp is not None and self.cache_time is not None:
+            edge.prune(edge.latest() - self.cache_time)
+
+    def add_list(self,transforms,internal_format=None):
+        for transform in transforms:
+            self.add(transform,internal_format=internal_format)
+
+    def frames(self):
+        return self._neighbors.keys()
+
+    def can_transform(self,from_frame,to_frame,stamp=None):
+        try:
+            self.lookup_pq(from_frame,to_frame,stamp)
+        except TransformLookupError:
+            return False
+        return True
+
+    def _get_chain(self,from_frame,to_frame):
+        key = (from_frame,to_frame)
+        chain = self._chains.get(key)
+        if chain is not None:
+            return chain
+        if from_frame not in self._neighbors or to_frame not in self._neighbors:
+            raise TransformLookupError('Unknown frame %s' % (from_frame if from_frame not in self._neighbors else to_frame))
+
+        parents = {from_frame: None}
+        queue = collections.deque([from_frame])
+        while queue and to_frame not in parents:
+            frame = queue.popleft()
+            for neighbor in self._neighbors[frame]:
+                if neighbor not in parents:
+                    parents[neighbor] = frame
+                    queue.append(neighbor)
+        if to_frame not in parents:
+            raise TransformLookupError('Frames %s and %s are not connected' % (from_frame,to_frame))
+
+        chain = []
+        frame = to_frame
+        while parents[frame] is not None:
+            prev = parents[frame]
+            if (prev,frame) in self._edges:
+                chain.append(((prev,frame),False))
+            else:
+                chain.append(((frame,prev),True))
+            frame = prev
+        chain.reverse()
+        self._chains[key] = chain
+        return chain
+
+    def lookup_pq(self,from_frame,to_frame,stamps=None):
+        """Returns the transforms from from_frame to to_frame at the given
+        stamps as an (N,7) array of (x,y,z,qx,qy,qz,qw) rows. A stamp of None
+        uses the latest data for each link."""
+        if stamps is None or np.isscalar(stamps):
+            stamps = [stamps]
+        stamps = np.array([np.nan if s is None else s for s in stamps], dtype=np.float64)
+        pq = np.zeros((len(stamps),7))
+        pq[:,6] = 1
+        if from_frame == to_frame:
+            return pq
+        for key, inverted in self._get_chain(from_frame,to_frame):
+            try:
+                link = self._edges[key].lookup(stamps)
+            except TransformLookupError as e:
+                raise TransformLookupError('%s (from %s to %s)' % (e.args[0],key[0],key[1]))
+            if inverted:
+                link = _invert_pq(link)
+            pq = _compose_pq(link,pq)
+        return pq
+
+    def lookup(self,from_frame,to_frame,stamp=None,internal_format='matrix'):
+        """Returns the transform from from_frame to to_frame at the given
+        stamp in the given internal format ('matrix', 'pq', or 'pr'). A stamp
+        of None uses the latest data for each link."""
+        pq = self.lookup_pq(from_frame,to_frame,stamp)[0]
+        if internal_format == 'pq':
+            return (pq[:3],pq[3:])
+        T = transformations.quaternion_matrix(pq[3:])
+        T[0:3,3] = pq[:3]
+        if internal_format in ['matrix','mat']:
+            return T
+        elif internal_format == 'pr':
+            return (pq[:3],T[0:3,0:3])
+        raise ValueError('Unknown internal format %s' % internal_format)
+
+    def lookup_array(self,from_frame,to_frame,stamps):
+        """Returns the transforms from from_frame to to_frame at each of the
+        given stamps as an (N,4,4) array."""
+        pq = self.lookup_pq(from_frame,to_frame,stamps)
+        T = transformations.quaternion_matrix_array(pq[:,3:])
+        T[:,0:3,3] = pq[:,:3]
+        return T
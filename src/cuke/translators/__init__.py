@@ -1,2 +1,3 @@
 import geom_numpy
-import image
\ No newline at end of file
+import image
+import pointcloud
@@ -6,12 +6,16 @@ from ..serializer import Translator, SerializationError, is_file_like
 from ..serializers import Rotation, Pose,Transform
 
 from . import transformations
-from raas.serializer import BinaryWithHeader
+from ..serializer import BinaryWithHeader, StringTable
+
+_STAMP = struct.Struct('d')
+
+_SMALLEST3_PATTERN = re.compile(r'(q|pq)\.smallest3\.(\d+)$')
 
 class NumpyRotationTranslator(Translator):
     @classmethod
     def known_wire_formats(cls,parent):
-        return ['q.array',re.compile(r'matrix.float(16|32|64)')]
+        return ['q.array',re.compile(r'matrix.float(16|32|64)'),re.compile(r'q\.smallest3\.\d+$')]
     
     @classmethod
     def known_internal_formats(cls,parent):
@@ -28,38 +32,52 @@ class NumpyRotationTranslator(Translator):
         return True
     
     @classmethod
-    def deserialize(cls,parent,data,wire_format,internal_format):
+    def deserialize(cls,parent,data,wire_format,internal_format,out=None):
+        offset = 0
         if 'stamped' in parent.PARAMETER_LIST:
-            size = struct.calcsize('d')
+            offset = _STAMP.size
             deserialized_data = {'stamp': None}
-            stamp = struct.unpack('d',data[:size])[0]
+            stamp = _STAMP.unpack_from(data)[0]
             if stamp != -1:
                 deserialized_data['stamp'] = stamp
-            data = data[size:]
         q = None
         R = None
         if wire_format.startswith('matrix.float'):
             dtype = wire_format[wire_format.find('.')+1:]
-            R = np.ones((4,4))
-            R[0:3,0:3] = np.frombuffer(data,dtype=dtype).reshape((3,3))
+            R = np.frombuffer(data,dtype=dtype,count=9,offset=offset).reshape((3,3))
             
         elif wire_format == 'q.array':
-            l = len(data) / 4
-            if l == 8:
-                dtype = np.float64
-            elif l == 4:
-                dtype = np.float32
-            elif l == 2:
-                dtype = np.float16
-            q = np.frombuffer(data,dtype=dtype)
+            l = len(data) - offset
+            dtype = _float_dtype(l // 4)
+            if dtype is None or l % 4 != 0:
+                raise SerializationError('q.array data of %d bytes is not 4 floats' % l)
+            q = np.frombuffer(data,dtype=dtype,count=4,offset=offset)
+        
+        elif wire_format.startswith('q.smallest3.'):
+            bits = _smallest3_bits(wire_format)
+            codes = np.frombuffer(data,dtype=np.uint8,count=_smallest3_size(bits),offset=offset)
+            q = _decode_smallest3(codes.reshape((1,-1)),bits)[0]
         
         if internal_format in ['matrix','mat']:
-            if R is None:
+            if out is not None:
+                _check_out(out,(3,3))
+                if R is None:
+                    _rotation_from_quaternion(q,out)
+                else:
+                    out[...] = R
+                R = out
+            elif R is None:
                 R = transformations.quaternion_matrix(q)[0:3,0:3]
             value = R
         elif internal_format == 'q':
             if q is None:
-                q = transformations.quaternion_from_matrix(R)[0:3,0:3]
+                T = np.identity(4)
+                T[0:3,0:3] = R
+                q = transformations.quaternion_from_matrix(T)
+            if out is not None:
+                _check_out(out,(4,))
+                out[...] = q
+                q = out
             value = q
         
         if 'stamped' in parent.PARAMETER_LIST:
@@ -69,24 +87,55 @@ class NumpyRotationTranslator(Translator):
             return value
 
     @classmethod
-    def attempt_deserialize(cls,parent,data,internal_format):
-        if 'stamped' in parent.PARAMETER_LIST:
-            l = len(data) - struct.calcsize('d')
-        else:
-            l = len(data)
-        dtypes = {'float64': 8, 'float32': 4, 'float16': 2}
-        for dt, b in dtypes.iteritems():
-            if l % b == 0 and l / b == 4:
-                q = np.frombuffer(data, dtype=dt)
-                if not any(np.isnan(q)) and np.allclose(np.linalg.norm(q),1):
-                    return q
-        for dt, b in dtypes.iteritems():
-            if l % b == 0 and l / b == 9:
-                R = np.frombuffer(data, dtype=dt).reshape((3,3))
-                if not any(np.isnan(q)) \
-                        and np.allclose(R.transpose(), R) \
-                        and np.allclose(np.linalg.det(R),1):
-                    return R
+    def sniff_wire_format(cls,parent,data,internal_format):
+        offset = _STAMP.size if 'stamped' in parent.PARAMETER_LIST else 0
+        l = len(data) - offset
+        dtype = _float_dtype(l // 4)
+        if dtype is not None and l % 4 == 0:
+            q = np.frombuffer(data, dtype=dtype, count=4, offset=offset)
+            if not np.any(np.isnan(q)) and np.allclose(np.linalg.norm(q),1,atol=1e-3):
+                return 'q.array'
+        dtype = _float_dtype(l // 9)
+        if dtype is not None and l % 9 == 0:
+            R = np.frombuffer(data, dtype=dtype, count=9, offset=offset).reshape((3,3))
+            if not np.any(np.isnan(R)) \
+                    and np.allclose(R.dot(R.transpose()), np.identity(3), atol=1e-3) \
+                    and np.allclose(np.linalg.det(R),1,atol=1e-3):
+                return 'matrix.' + np.dtype(dtype).name
+        return None
+
+    @classmethod
+    def deserialize_list(cls,parent,data,wire_format,internal_format,out=None):
+        if 'stamped' in parent.PARAMETER_LIST or internal_format not in ['matrix','mat','q']:
+            return None
+        buf, l = _join_payloads(data)
+        if buf is None:
+            return None
+        n = len(data)
+        if wire_format == 'q.array':
+            dtype = _float_dtype(l // 4)
+            if dtype is None or l % 4:
+                return None
+            q = np.frombuffer(buf,dtype=dtype).reshape((n,4))
+            if internal_format == 'q':
+                return _into(out,q)
+            return _into(out,transformations.quaternion_matrix_array(q)[:,0:3,0:3])
+        elif wire_format.startswith('matrix.float'):
+            dtype = np.dtype(wire_format[wire_format.find('.')+1:])
+            if l != 9 * dtype.itemsize:
+                return None
+            R = np.frombuffer(buf,dtype=dtype).reshape((n,3,3))
+            if internal_format in ['matrix','mat']:
+                return _into(out,R)
+            return _into(out,transformations.quaternion_from_matrix_array(R))
+        elif wire_format.startswith('q.smallest3.'):
+            bits = _smallest3_bits(wire_format)
+            if l != _smallest3_size(bits):
+                return None
+            q = _decode_smallest3(np.frombuffer(buf,dtype=np.uint8).reshape((n,l)),bits)
+            if internal_format == 'q':
+                return _into(out,q)
+            return _into(out,transformations.quaternion_matrix_array(q)[:,0:3,0:3])
         return None
 
     @classmethod
@@ -96,45 +145,110 @@ class NumpyRotationTranslator(Translator):
             if isinstance(data,dict):
                 stamp = data.get('stamp')
                 data = data.get('value')
-        T = _get_canonical_matrix(data)
-        if wire_format == 'q.array':
+        q = _as_quaternion(data) if internal_format == 'q' else None
+        if wire_format == 'q.array' and q is not None:
+            value = _unit_quaternion(q).tostring()
+        elif wire_format == 'q.array':
+            T = _get_canonical_matrix(data, internal_format)
             q = transformations.quaternion_from_matrix(T)
             value = q.tostring()
-        if wire_format.startswith('matrix.'):
+        elif wire_format.startswith('matrix.'):
+            T = _get_canonical_matrix(data, internal_format)
             dtype = np.dtype(wire_format[wire_format.find('.')+1:])
             T = T[0:3,0:3].astype(np.dtype(dtype))
             value = T.tostring()
+        elif wire_format.startswith('q.smallest3.'):
+            if q is None:
+                q = transformations.quaternion_from_matrix(_get_canonical_matrix(data, internal_format))
+            value = _encode_smallest3(q.reshape((1,4)),_smallest3_bits(wire_format)).tostring()
         else:
             raise SerializationError('Unknown wire_format %s' % wire_format)
         
         if 'stamped' in parent.PARAMETER_LIST:
-            value = struct.pack('d', stamp) + value
+            value = _STAMP.pack(stamp) + value
         
         return value
+    
+    @classmethod
+    def serialize_list(cls,parent,data,internal_format,wire_format):
+        if 'stamped' in parent.PARAMETER_LIST:
+            return None
+        data = np.asarray(data)
+        if data.ndim == 3 and data.shape[1:] in [(3,3),(4,4)] and internal_format in [None,'matrix','mat']:
+            R = data[:,0:3,0:3]
+            q = None
+        elif data.ndim == 2 and data.shape[1] == 4 and internal_format in [None,'q']:
+            R = None
+            q = data
+        else:
+            return None
+        if wire_format == 'q.array':
+            if q is None:
+                q = transformations.quaternion_from_matrix_array(R)
+            value = q.astype(np.float64)
+        elif wire_format.startswith('matrix.'):
+            if R is None:
+                R = transformations.quaternion_matrix_array(q)[:,0:3,0:3]
+            value = R.astype(np.dtype(wire_format[wire_format.find('.')+1:]))
+        elif wire_format.startswith('q.smallest3.'):
+            if q is None:
+                q = transformations.quaternion_from_matrix_array(R)
+            value = _encode_smallest3(q,_smallest3_bits(wire_format))
+        else:
+            return None
+        return _split_payloads(value)
         
 Rotation.add_translator(NumpyRotationTranslator)
 
 class NumpyPoseTfTranslator(Translator):
+    """Translator for Pose and Transform.
+    
+    The parameters 'stamped' and 'frame' add a header with the stamp and the
+    frame (Pose) or from_frame/to_frame (Transform). Decoded frame names are
+    interned. With the additional parameter frame_table=<name>, frame names
+    are sent as codes from the StringTable of that name (see StringTable for
+    how the tables are kept in sync).
+    
+    The wire format pq.smallest3.<bits> sends the rotation as a smallest-three
+    quaternion (see smallest3_error_bound) and the position as float32, or,
+    with the parameter resolution=<meters>, as int32 multiples of the
+    resolution. Both sides must declare the same resolution.
+    
+    Deserializing into an output buffer fills and returns it: a (4,4) array
+    for the matrix internal format, or a (7,) array of the position followed
+    by the quaternion for pq."""
+    _BWH_CACHE = {}
+    
     @classmethod
     def _get_bwh(cls,parent):
+        is_pose = issubclass(parent,Pose)
+        framed = 'frame' in parent.PARAMETER_LIST
+        stamped = 'stamped' in parent.PARAMETER_LIST
+        frame_table = parent.PARAMETER_DICT.get('frame_table') if framed else None
+        key = (is_pose, framed, stamped, frame_table)
+        if key in cls._BWH_CACHE:
+            return cls._BWH_CACHE[key]
+        
         bwh_fields = []
-        if 'frame' in parent.PARAMETER_LIST:
-            if issubclass(parent,Pose):
+        if framed:
+            if is_pose:
                 bwh_fields.append((str,'frame'))
             else:
                 bwh_fields.append((str,'from_frame'))
                 bwh_fields.append((str,'to_frame'))
-        if 'stamped' in parent.PARAMETER_LIST:
+        if stamped:
             bwh_fields.append((float,'stamp'))
         
+        bwh = None
         if bwh_fields:
-            return BinaryWithHeader(*bwh_fields)
-        else:
-            return None
+            string_table = StringTable.get(frame_table) if frame_table else None
+            bwh = BinaryWithHeader(*bwh_fields, intern_strings=True, string_table=string_table)
+        cls._BWH_CACHE[key] = bwh
+        return bwh
 
     @classmethod
     def known_wire_formats(cls,parent):
-        return ['pq.array',re.compile(r'rowmajor\.float(16|32|64)')]
+        return ['pq.array',re.compile(r'rowmajor\.float(16|32|64)'),re.compile(r'pq\.smallest3\.\d+$')]
     
     @classmethod
     def known_internal_formats(cls,parent):
@@ -143,7 +257,8 @@ class NumpyPoseTfTranslator(Translator):
     @classmethod
     def can_serialize(cls, parent, data, internal_format, wire_format):
         if data is not None and not isinstance(data,(np.ndarray,list,tuple)):
-            return False
+            if not (isinstance(data,dict) and cls._get_bwh(parent)):
+                return False
         return super(NumpyPoseTfTranslator, cls).can_serialize(parent, data, internal_format, wire_format)
     
     @classmethod
@@ -151,11 +266,12 @@ class NumpyPoseTfTranslator(Translator):
         return True
     
     @classmethod
-    def deserialize(cls,parent,data,wire_format,internal_format):
+    def deserialize(cls,parent,data,wire_format,internal_format,out=None):
         value_dict = None
+        offset = 0
         bwh = cls._get_bwh(parent)
         if bwh:
-            value_dict, data = bwh.unpack(data)
+            value_dict, offset = bwh.unpack_from(data)
             if value_dict.has_key('stamp') and value_dict['stamp'] == -1:
                 value_dict['stamp'] = None
         
@@ -163,32 +279,51 @@ class NumpyPoseTfTranslator(Translator):
         T = None
         if wire_format.startswith('rowmajor.'):
             dtype = np.dtype(wire_format[wire_format.find('.')+1:])
-            T = np.frombuffer(data,dtype=dtype).reshape((4,4))
+            T = np.frombuffer(data,dtype=dtype,count=16,offset=offset).reshape((4,4))
         elif wire_format == 'pq.array':
-            l = len(data) / 7
-            if l == 8:
-                dtype = np.float64
-            elif l == 4:
-                dtype = np.float32
-            elif l == 2:
-                dtype = np.float16
-            pq = np.frombuffer(data,dtype=dtype)
+            l = len(data) - offset
+            dtype = _float_dtype(l // 7)
+            if dtype is None or l % 7 != 0:
+                raise SerializationError('pq.array data of %d bytes is not 7 floats' % l)
+            pq = np.frombuffer(data,dtype=dtype,count=7,offset=offset)
+        elif wire_format.startswith('pq.smallest3.'):
+            bits = _smallest3_bits(wire_format)
+            codes = np.frombuffer(data,dtype=np.uint8,count=12+_smallest3_size(bits),offset=offset)
+            pq = _decode_pq_smallest3(codes.reshape((1,-1)),bits,_get_resolution(parent))[0]
         
         if internal_format in ['matrix','mat']:
-            if T is None:
+            if out is not None:
+                _check_out(out,(4,4))
+                if T is None:
+                    out[3,:] = (0,0,0,1)
+                    out[0:3,3] = pq[:3]
+                    _rotation_from_quaternion(pq[3:],out[0:3,0:3])
+                else:
+                    out[...] = T
+                T = out
+            elif T is None:
                 T = np.eye(4)
                 T[0:3,3] = pq[:3]
                 T[0:3,0:3] = transformations.quaternion_matrix(pq[3:])[0:3,0:3]
             value = T
         elif internal_format == 'pq':
-            if pq is None:
-                p = T[0:3,3]
-                q = transformations.quaternion_from_matrix(T)[0:3,0:3]
+            if out is not None:
+                _check_out(out,(7,))
+                if pq is None:
+                    out[:3] = T[0:3,3]
+                    out[3:] = transformations.quaternion_from_matrix(T)
+                else:
+                    out[...] = pq
+                # The buffer holds the position followed by the quaternion,
+                # and is returned itself rather than split into (p,q)
+                value = out
+            elif pq is None:
+                value = (T[0:3,3],transformations.quaternion_from_matrix(T))
             else:
-                p = pq[:3]
-                q = pq[3:]
-            value = (p,q)
+                value = (pq[:3],pq[3:])
         elif internal_format == 'pr':
+            if out is not None:
+                raise SerializationError('Internal format pr does not support an output buffer')
             if pq is None:
                 p = T[0:3,3]
                 r = T[0:3,0:3]
@@ -205,38 +340,73 @@ class NumpyPoseTfTranslator(Translator):
                 
     
     @classmethod
-    def attempt_deserialize(cls,parent,data,internal_format, try_bwh=True):
-        if try_bwh:
-            bwh = cls._get_bwh(parent)
-            if bwh:
-                try:
-                    _, payload_data = bwh.unpack(data)
-                    ret = cls.attempt_deserialize(parent, payload_data, internal_format, try_bwh=False)
-                    if ret is None:
-                        return cls.attempt_deserialize(parent, data, internal_format, try_bwh=False)
-                    else:
-                        return ret
-                except:
-                    pass
-        
-        l = len(data)
-        
-        if l % 7 == 0:
-            wire_format = 'pq.array'
-        elif l % 16 == 0:
-            b = l/16
-            if b == 8:
-                wire_format = 'rowmajor.float64'
-            elif b == 4:
-                wire_format = 'rowmajor.float32'
-            elif b == 2:
-                wire_format = 'rowmajor.float16'
-            else:
-                return None
-        else:
+    def affinity_key(cls,parent,data):
+        bwh = cls._get_bwh(parent)
+        if not bwh:
+            return len(data)
+        try:
+            _, offset = bwh.unpack_from(data)
+        except struct.error:
             return None
-        
-        return cls.deserialize(parent, data, wire_format, internal_format)
+        return len(data) - offset
+    
+    @classmethod
+    def sniff_wire_format(cls,parent,data,internal_format):
+        l = cls.affinity_key(parent,data)
+        if l is None:
+            return None
+        if l % 7 == 0 and _float_dtype(l // 7):
+            return 'pq.array'
+        elif l % 16 == 0 and _float_dtype(l // 16):
+            return 'rowmajor.' + np.dtype(_float_dtype(l // 16)).name
+        return None
+
+    @classmethod
+    def deserialize_list(cls,parent,data,wire_format,internal_format,out=None):
+        if cls._get_bwh(parent) or internal_format not in ['matrix','mat','pq']:
+            return None
+        buf, l = _join_payloads(data)
+        if buf is None:
+            return None
+        n = len(data)
+        if wire_format == 'pq.array':
+            dtype = _float_dtype(l // 7)
+            if dtype is None or l % 7:
+                return None
+            pq = np.frombuffer(buf,dtype=dtype).reshape((n,7))
+            if internal_format == 'pq':
+                return _into(out,pq)
+            if out is not None:
+                _check_out(out,(n,4,4))
+            T = transformations.quaternion_matrix_array(pq[:,3:],out=out)
+            T[:,0:3,3] = pq[:,:3]
+            return T
+        elif wire_format.startswith('rowmajor.'):
+            dtype = np.dtype(wire_format[wire_format.find('.')+1:])
+            if l != 16 * dtype.itemsize:
+                return None
+            T = np.frombuffer(buf,dtype=dtype).reshape((n,4,4))
+            if internal_format in ['matrix','mat']:
+                return _into(out,T)
+            if out is None:
+                out = np.empty((n,7))
+            _check_out(out,(n,7))
+            out[:,:3] = T[:,0:3,3]
+            out[:,3:] = transformations.quaternion_from_matrix_array(T)
+            return out
+        elif wire_format.startswith('pq.smallest3.'):
+            bits = _smallest3_bits(wire_format)
+            if l != 12 + _smallest3_size(bits):
+                return None
+            pq = _decode_pq_smallest3(np.frombuffer(buf,dtype=np.uint8).reshape((n,l)),bits,_get_resolution(parent))
+            if internal_format == 'pq':
+                return _into(out,pq)
+            if out is not None:
+                _check_out(out,(n,4,4))
+            T = transformations.quaternion_matrix_array(pq[:,3:],out=out)
+            T[:,0:3,3] = pq[:,:3]
+            return T
+        return None
 
     @classmethod
     def serialize(cls,parent,data,internal_format,wire_format):
@@ -244,28 +414,37 @@ class NumpyPoseTfTranslator(Translator):
         bwh_input = {}
         if 'stamped' in parent.PARAMETER_LIST:
             stamp = float(-1)
-            if isinstance(data,dict):
+            if isinstance(data,dict) and data.get('stamp') is not None:
                 stamp = data.get('stamp')
-                data = data.get('value')
             bwh_input['stamp'] = stamp
-        if 'frame' in parent.PARAMETER_LIST:
-            if isinstance(data,dict):
-                if issubclass(parent,Pose):
-                    bwh_input['frame'] = data.get('frame')
-                else:
-                    bwh_input['from_frame'] = data.get('from_frame')
-                    bwh_input['to_frame'] = data.get('to_frame')
-                data = data.get('value')
+        if 'frame' in parent.PARAMETER_LIST and isinstance(data,dict):
+            if issubclass(parent,Pose):
+                bwh_input['frame'] = data.get('frame') or ''
+            else:
+                bwh_input['from_frame'] = data.get('from_frame') or ''
+                bwh_input['to_frame'] = data.get('to_frame') or ''
+        if bwh and isinstance(data,dict):
+            data = data.get('value')
 
-        T = _get_canonical_matrix(data)
-        if wire_format == 'pq.array':
+        pq = _as_pq(data) if internal_format == 'pq' else None
+        if wire_format == 'pq.array' and pq is not None:
+            value = np.hstack((pq[0],_unit_quaternion(pq[1]))).tostring()
+        elif wire_format == 'pq.array':
+            T = _get_canonical_matrix(data, internal_format)
             p = T[0:3,3]
             q = transformations.quaternion_from_matrix(T)
             value = np.hstack((p,q)).tostring()
         elif wire_format.startswith('rowmajor.'):
+            T = _get_canonical_matrix(data, internal_format)
             dtype = np.dtype(wire_format[wire_format.find('.')+1:])
             T = T.astype(np.dtype(dtype))
             value = T.tostring()
+        elif wire_format.startswith('pq.smallest3.'):
+            if pq is None:
+                T = _get_canonical_matrix(data, internal_format)
+                pq = (T[0:3,3], transformations.quaternion_from_matrix(T))
+            pq = np.hstack(pq).reshape((1,7))
+            value = _encode_pq_smallest3(pq,_smallest3_bits(wire_format),_get_resolution(parent)).tostring()
         else:
             raise SerializationError('Unknown wire_format %s' % wire_format)
         
@@ -273,11 +452,280 @@ class NumpyPoseTfTranslator(Translator):
             value = bwh.pack(value,**bwh_input)
         
         return value
+    
+    @classmethod
+    def serialize_list(cls,parent,data,internal_format,wire_format):
+        if cls._get_bwh(parent):
+            return None
+        data = np.asarray(data)
+        if data.ndim == 3 and data.shape[1:] == (4,4) and internal_format in [None,'matrix','mat']:
+            T = data
+            pq = None
+        elif data.ndim == 2 and data.shape[1] == 7 and internal_format in [None,'pq']:
+            T = None
+            pq = data
+        else:
+            return None
+        if wire_format == 'pq.array':
+            if pq is None:
+                pq = np.empty((len(T),7))
+                pq[:,:3] = T[:,0:3,3]
+                pq[:,3:] = transformations.quaternion_from_matrix_array(T)
+            value = pq.astype(np.float64)
+        elif wire_format.startswith('rowmajor.'):
+            if T is None:
+                T = transformations.quaternion_matrix_array(pq[:,3:])
+                T[:,0:3,3] = pq[:,:3]
+            value = T.astype(np.dtype(wire_format[wire_format.find('.')+1:]))
+        elif wire_format.startswith('pq.smallest3.'):
+            if pq is None:
+                pq = np.empty((len(T),7))
+                pq[:,:3] = T[:,0:3,3]
+                pq[:,3:] = transformations.quaternion_from_matrix_array(T)
+            value = _encode_pq_smallest3(pq,_smallest3_bits(wire_format),_get_resolution(parent))
+        else:
+            return None
+        return _split_payloads(value)
 
 Pose.add_translator(NumpyPoseTfTranslator)
 Transform.add_translator(NumpyPoseTfTranslator)
 
-def _get_canonical_matrix(data):
+def _float_dtype(size):
+    return {8: np.float64, 4: np.float32, 2: np.float16}.get(size)
+
+def _join_payloads(data):
+    """Concatenates a list of binary payloads of equal length, returning the
+    joined buffer and the payload length, or (None, None) if the list cannot
+    be decoded as a batch."""
+    if not data or not all(isinstance(d,(bytes,bytearray)) for d in data):
+        return None, None
+    l = len(data[0])
+    if not l or any(len(d) != l for d in data):
+        return None, None
+    return bytearray().join(data), l
+
+def _split_payloads(value):
+    """Splits an array of N values into a list of N binary payloads."""
+    if not len(value):
+        return []
+    b = value.tostring()
+    n = len(b) // len(value)
+    return [b[i:i+n] for i in xrange(0,len(b),n)]
+
+def _into(out,value):
+    if out is None:
+        return value
+    _check_out(out,value.shape)
+    out[...] = value
+    return out
+
+def _check_out(out,shape):
+    if not isinstance(out,np.ndarray) or out.shape != shape:
+        raise SerializationError('Output buffer must be an array of shape %s' % (shape,))
+
+def _smallest3_bits(wire_format):
+    match = _SMALLEST3_PATTERN.match(wire_format)
+    bits = int(match.group(2)) if match else 0
+    if not 2 <= bits <= 20:
+        raise SerializationError('Invalid smallest-three wire format %s; bits must be between 2 and 20' % wire_format)
+    return bits
+
+def _smallest3_size(bits):
+    return (2 + 3 * bits + 7) // 8
+
+def smallest3_error_bound(bits, resolution=None):
+    """Returns the maximum error introduced by the smallest-three wire
+    formats with the given number of bits per component, as a tuple of the
+    rotation angle error in radians and the position error (None for float32
+    positions)."""
+    # The three smallest components lie in [-1/sqrt(2), 1/sqrt(2)]
+    e = 1. / (np.sqrt(2) * ((1 << bits) - 1))
+    # Error of the largest component, which is at least 1/2, when it is
+    # recomputed from the other three
+    e_max = 3 * e + 3 * e * e
+    dq = np.sqrt(3 * e * e + e_max * e_max)
+    angle = 4 * np.arcsin(min(dq / 2, 1.))
+    return angle, (None if resolution is None else resolution / 2.)
+
+def _encode_smallest3(q,bits):
+    """Encodes an (N,4) array of quaternions as an (N,M) array of bytes, each
+    row holding the index of the largest component in two bits followed by
+    the other three components with the given number of bits each."""
+    q = np.asarray(q, dtype=np.float64)
+    q = q / np.sqrt(np.sum(q*q,axis=1))[:,np.newaxis]
+    n = len(q)
+    rows = np.arange(n)
+    largest = np.argmax(np.abs(q),axis=1)
+    q = q * np.where(q[rows,largest] < 0, -1., 1.)[:,np.newaxis]
+    others = np.array([[1,2,3],[0,2,3],[0,1,3],[0,1,2]])[largest]
+    small = q[rows[:,np.newaxis],others]
+    scale = (1 << bits) - 1
+    ints = np.rint((np.clip(small * np.sqrt(2),-1.,1.) + 1.) * (scale / 2.)).astype(np.uint64)
+    codes = largest.astype(np.uint64)
+    for i in range(3):
+        codes = (codes << np.uint64(bits)) | ints[:,i]
+    size = _smallest3_size(bits)
+    return codes.astype('<u8').view(np.uint8).reshape((n,8))[:,:size]
+
+def _decode_smallest3(data,bits):
+    """Decodes an (N,M) array of bytes produced by _encode_smallest3 into an
+    (N,4) array of quaternions."""
+    n, size = data.shape
+    buf = np.zeros((n,8), dtype=np.uint8)
+    buf[:,:size] = data
+    codes = buf.view('<u8').reshape((n,)).astype(np.uint64)
+    scale = (1 << bits) - 1
+    mask = np.uint64(scale)
+    small = np.empty((n,3))
+    for i in range(2,-1,-1):
+        small[:,i] = (codes & mask).astype(np.float64)
+        codes = codes >> np.uint64(bits)
+    small = (small * (2. / scale) - 1.) / np.sqrt(2)
+    largest = (codes & np.uint64(3)).astype(np.intp)
+    q = np.empty((n,4))
+    rows = np.arange(n)
+    others = np.array([[1,2,3],[0,2,3],[0,1,3],[0,1,2]])[largest]
+    q[rows[:,np.newaxis],others] = small
+    q[rows,largest] = np.sqrt(np.maximum(1. - np.sum(small*small,axis=1),0.))
+    return q
+
+def _get_resolution(parent):
+    resolution = parent.PARAMETER_DICT.get('resolution')
+    return None if resolution is None else float(resolution)
+
+def _encode_pq_smallest3(pq,bits,resolution):
+    pq = np.asarray(pq, dtype=np.float64)
+    if resolution is None:
+        p = pq[:,:3].astype('<f4')
+    else:
+        p = np.rint(pq[:,:3] / resolution)
+        if np.any(np.abs(p) > np.iinfo(np.int32).max):
+            raise SerializationError('Position is out of range for resolution %g' % resolution)
+        p = p.astype('<i4')
+    return np.hstack((p.view(np.uint8).reshape((len(pq),12)),_encode_smallest3(pq[:,3:],bits)))
+
+def _decode_pq_smallest3(data,bits,resolution):
+    data = np.ascontiguousarray(data)
+    n = len(data)
+    pq = np.empty((n,7))
+    if resolution is None:
+        pq[:,:3] = data[:,:12].copy().view('<f4')
+    else:
+        pq[:,:3] = data[:,:12].copy().view('<i4') * resolution
+    pq[:,3:] = _decode_smallest3(data[:,12:],bits)
+    return pq
+
+def _rotation_from_quaternion(q,out):
+    """Writes the rotation matrix for quaternion q into the 3x3 array out
+    without allocating any intermediate arrays."""
+    x, y, z, w = float(q[0]), float(q[1]), float(q[2]), float(q[3])
+    n = x*x + y*y + z*z + w*w
+    if n < transformations._EPS:
+        out[...] = 0
+        out[0,0] = out[1,1] = out[2,2] = 1
+        return out
+    s = 2.0 / n
+    xx, yy, zz = x*x*s, y*y*s, z*z*s
+    xy, xz, yz = x*y*s, x*z*s, y*z*s
+    wx, wy, wz = w*x*s, w*y*s, w*z*s
+    out[0,0] = 1.0-yy-zz; out[0,1] = xy-wz;     out[0,2] = xz+wy
+    out[1,0] = xy+wz;     out[1,1] = 1.0-xx-zz; out[1,2] = yz-wx
+    out[2,0] = xz-wy;     out[2,1] = yz+wx;     out[2,2] = 1.0-xx-yy
+    return out
+
+def _unit_quaternion(q):
+    return q / np.sqrt(np.dot(q,q))
+
+def _as_quaternion(data):
+    """Returns data as a float64 quaternion of shape (4,), or None if it does
+    not have 4 elements in a single row or column."""
+    try:
+        q = np.asarray(data, dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    if q.shape not in [(4,),(4,1),(1,4)]:
+        return None
+    return q.reshape((4,))
+
+def _as_pq(data):
+    """Returns the position and quaternion of pq data, a (p, q) pair or a
+    7-vector, as float64 arrays of shape (3,) and (4,), or None if the data
+    has any other shape."""
+    try:
+        if not isinstance(data,np.ndarray) and len(data) == 2:
+            p = np.asarray(data[0], dtype=np.float64)
+            q = np.asarray(data[1], dtype=np.float64)
+            if p.size != 3 or max(p.shape) != 3:
+                return None
+            q = _as_quaternion(q)
+            if q is None:
+                return None
+            return p.reshape((3,)), q
+        pq = np.asarray(data, dtype=np.float64)
+    except (TypeError, ValueError, KeyError, IndexError):
+        return None
+    if pq.shape not in [(7,),(7,1),(1,7)]:
+        return None
+    pq = pq.reshape((7,))
+    return pq[:3], pq[3:]
+
+def _matrix_to_canonical(data):
+    try:
+        data = np.asarray(data, dtype=float)
+    except (TypeError, ValueError):
+        return None
+    if data.shape == (4,4):
+        return data
+    elif data.shape == (3,3):
+        T = np.identity(4, dtype=float)
+        T[0:3,0:3] = data
+        return T
+    return None
+
+def _pq_to_canonical(data):
+    pq = _as_pq(data)
+    if pq is None:
+        return None
+    T = transformations.quaternion_matrix(pq[1])
+    T[0:3,3] = pq[0]
+    return T
+
+def _pr_to_canonical(data):
+    try:
+        if isinstance(data,np.ndarray) or len(data) != 2:
+            return None
+        p = np.asarray(data[0], dtype=float)
+        r = np.asarray(data[1], dtype=float)
+    except (TypeError, ValueError, KeyError, IndexError):
+        return None
+    if p.size != 3 or max(p.shape) != 3 or r.shape != (3,3):
+        return None
+    T = np.identity(4, dtype=float)
+    T[0:3,3] = p.reshape((3,))
+    T[0:3,0:3] = r
+    return T
+
+def _q_to_canonical(data):
+    q = _as_quaternion(data)
+    if q is None:
+        return None
+    return transformations.quaternion_matrix(q)
+
+# Direct converters for data whose layout is given by the internal format,
+# so that it does not need to go through _get_type. They return None for
+# data of any other shape, which then goes through _get_type after all.
+_CANONICAL_CONVERTERS = {'matrix': _matrix_to_canonical,
+                         'mat': _matrix_to_canonical,
+                         'pq': _pq_to_canonical,
+                         'pr': _pr_to_canonical,
+                         'q': _q_to_canonical}
+
+def _get_canonical_matrix(data, internal_format=None):
+    converter = _CANONICAL_CONVERTERS.get(internal_format)
+    if converter is not None:
+        T = converter(data)
+        if T is not None:
+            return T
     T = np.identity(4, dtype=float)
     data_type, data = _get_data(data, default_4_to_quat=True)
     if data_type in ['tf','ps']:
@@ -298,6 +746,16 @@ def _get_canonical_matrix(data):
         T = transformations.quaternion_matrix(data)
     return T
 
+def pose_to_pq(data, internal_format=None):
+    """Returns a pose or transform in the given internal format (or of any
+    type that can be inferred, if it is None) as a float64 array
+    (x,y,z,qx,qy,qz,qw)."""
+    pq = _as_pq(data) if internal_format in ['pq',None] else None
+    if pq is None:
+        T = _get_canonical_matrix(data, internal_format)
+        pq = (T[0:3,3], transformations.quaternion_from_matrix(T))
+    return np.hstack(pq)
+
 def _get_axis_angle(val1,val2):
     if isinstance(val1,numbers.Number) and isinstance(val2,collections.Sequence) and len(val2) == 3:
         return (np.array(val2),val1)
@@ -310,7 +768,38 @@ def _get_axis_angle(val1,val2):
     else:
         return None
 
+_TYPE_CACHE = {}
+_TYPE_CACHE_SIZE = 256
+
+def _type_signature(value):
+    """Returns a hashable signature of value if its inferred type depends only
+    on its shape, or None if the type depends on the values themselves."""
+    if isinstance(value,np.ndarray):
+        if value.size == 4 and value.shape != (4,1):
+            return None
+        return value.shape
+    elif isinstance(value,tuple) and len(value) == 2:
+        sig1 = _type_signature(value[0])
+        sig2 = _type_signature(value[1])
+        if sig1 is None or sig2 is None:
+            return None
+        return (sig1, sig2)
+    return None
+
 def _get_type(value,default_4_to_quat=False,default_4_to_pt=False):
+    signature = _type_signature(value)
+    if signature is None:
+        return _infer_type(value,default_4_to_quat=default_4_to_quat,default_4_to_pt=default_4_to_pt)
+    key = (signature, default_4_to_quat, default_4_to_pt)
+    data_type = _TYPE_CACHE.get(key)
+    if data_type is None:
+        data_type = _infer_type(value,default_4_to_quat=default_4_to_quat,default_4_to_pt=default_4_to_pt)
+        if len(_TYPE_CACHE) >= _TYPE_CACHE_SIZE:
+            _TYPE_CACHE.clear()
+        _TYPE_CACHE[key] = data_type
+    return data_type
+
+def _infer_type(value,default_4_to_quat=False,default_4_to_pt=False):
     #base types: tf, ps, p, q, r, u, s
     #sub types: d, v#, a#, l#, t
     
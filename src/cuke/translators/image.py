@@ -1,69 +1,431 @@
 from __future__ import absolute_import
 
-import sys
-from ..serializer import Translator, SerializationError, is_file_like
-from ..serializers import Image
+import hashlib, struct
+import collections, multiprocessing, multiprocessing.pool, threading
+from cStringIO import StringIO
+from ..serializer import Translator, SerializationError, is_file_like, BinaryWithHeader
+from ..serializers import Image, _parse_roi, _load_npy
 
 import numpy
 
-_CV = False
-try:
-    cv2 = __import__('cv2')
-    _CV = True
-except:
-    sys.stderr.write('Cannot find OpenCV, not creating Image serializer\n')
-    pass
-
-if _CV:
-    class NumpyImageTranslator(Translator):
-        @classmethod
-        def known_wire_formats(cls,parent):
-            return ['jpg','png','bmp','numpy']
-
-        @classmethod
-        def known_internal_formats(cls,parent):
-            return ['numpy']
-
-        @classmethod
-        def extension_for_format(cls,format):
-            return '.' + format
-
-        @classmethod
-        def is_binary(cls,parent,wire_format):
-            return True
-
-        @classmethod
-        def deserialize(cls,parent,data,wire_format,internal_format):
-            mat = cv2.imdecode(numpy.array(data), flags = cv2.CV_LOAD_IMAGE_UNCHANGED)
-            if mat is None or len(mat) == 0:
-                raise SerializationError()
-            if internal_format == 'numpy':
-                return mat
-            else:
-                _, mat = cv2.imencode(cls.extension_for_format(wire_format), mat)
-                b = bytearray(mat.tostring())
-                return b
-
-        @classmethod
-        def attempt_deserialize(cls,parent,data,internal_format):
-            mat = cv2.imdecode(numpy.array(data), flags = cv2.CV_LOAD_IMAGE_UNCHANGED)
-            if mat is None or len(mat) == 0:
+# OpenCV is imported on first use, so that it is only loaded by programs that
+# encode or decode images. The raw and numpy wire formats do not need it.
+# cv2 is False once the import has failed, so it is only attempted once.
+cv2 = None
+_CV_LOCK = threading.Lock()
+
+# Wire formats that do not use an OpenCV codec
+_NUMPY_FORMATS = ['raw','numpy']
+
+def _load_cv2():
+    global cv2
+    if cv2 is None:
+        with _CV_LOCK:
+            if cv2 is None:
+                try:
+                    import cv2 as _cv2
+                except ImportError:
+                    _cv2 = False
+                cv2 = _cv2
+    return cv2
+
+def _get_cv2():
+    if not _load_cv2():
+        raise SerializationError('OpenCV is required to encode and decode jpg, png, bmp, and webp images')
+    return cv2
+
+def _has_cv2():
+    return _load_cv2() is not False
+
+def _cv_flag(name, legacy_name):
+    """Returns the OpenCV constant with the given name, falling back to its
+    name in OpenCV 2."""
+    cv = _get_cv2()
+    if hasattr(cv,name):
+        return getattr(cv,name)
+    return getattr(getattr(cv,'cv',cv),legacy_name)
+
+# Header for the raw wire format, followed by the pixels in C order
+_RAW_HEADER = BinaryWithHeader((int,'height'),(int,'width'),(int,'channels'),(str,'dtype'))
+
+def _decode_raw(data):
+    """Returns the image in the raw wire format as an array over the given
+    buffer, without copying."""
+    try:
+        header, offset = _RAW_HEADER.unpack_from(data)
+        dtype = numpy.dtype(header['dtype'])
+    except (struct.error, TypeError):
+        raise SerializationError('Invalid raw image header')
+    shape = (header['height'],header['width'])
+    if header['channels']:
+        shape += (header['channels'],)
+    count = int(numpy.prod(shape))
+    if len(data) - offset != count * dtype.itemsize:
+        raise SerializationError('Raw image data has %d bytes, expected %d' % (len(data) - offset, count * dtype.itemsize))
+    return numpy.frombuffer(data,dtype=dtype,count=count,offset=offset).reshape(shape)
+
+def _encode_numpy(mat):
+    sio = StringIO()
+    numpy.save(sio, numpy.asarray(mat))
+    return bytearray(sio.getvalue())
+
+def _encode_raw(mat):
+    mat = numpy.ascontiguousarray(mat)
+    if mat.ndim not in (2,3):
+        raise SerializationError('Raw images must have 2 or 3 dimensions, not %d' % mat.ndim)
+    channels = mat.shape[2] if mat.ndim == 3 else 0
+    return _RAW_HEADER.pack(buffer(mat),height=mat.shape[0],width=mat.shape[1],channels=channels,dtype=mat.dtype.str)
+
+# Default number of threads used to encode and decode lists of images; None
+# uses one per CPU. Can be overridden per serializer with Image(threads=N).
+THREADS = None
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def _get_pool(threads):
+    with _POOLS_LOCK:
+        pool = _POOLS.get(threads)
+        if pool is None:
+            pool = _POOLS[threads] = multiprocessing.pool.ThreadPool(threads)
+        return pool
+
+class EncodedImageCache(object):
+    """A bounded LRU cache of encoded images, for images that are published
+    repeatedly (e.g. static maps). Entries are keyed by a SHA-1 digest of the
+    pixels together with the shape, dtype, wire format, and encoder
+    parameters, and the least recently used entries are evicted once the
+    encoded bytes exceed max_bytes.
+    
+    The cache is opt-in: set the module-level ENCODE_CACHE to an instance."""
+    def __init__(self,max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @classmethod
+    def key(cls,mat,wire_format,params):
+        mat = numpy.ascontiguousarray(mat)
+        buf = buffer(mat)
+        return (hashlib.sha1(buf).digest(), mat.shape, mat.dtype.str, wire_format, tuple(params))
+    
+    def get(self,key):
+        with self._lock:
+            value = self._entries.pop(key,None)
+            if value is None:
+                self.misses += 1
                 return None
-            if internal_format == 'numpy':
-                return mat
+            self._entries[key] = value
+            self.hits += 1
+            return value
+    
+    def put(self,key,value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key,None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+    
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+# Cache used when encoding images, or None to always encode
+ENCODE_CACHE = None
+
+# Leading bytes of the wire formats
+_MAGIC = [('\xff\xd8\xff', 'jpg'), ('\x89PNG\r\n\x1a\n', 'png'), ('BM', 'bmp'), ('\x93NUMPY', 'numpy')]
+
+def _sniff_format(data):
+    head = str(data[:12])
+    for magic, wire_format in _MAGIC:
+        if head.startswith(magic):
+            return wire_format
+    if head.startswith('RIFF') and head[8:12] == 'WEBP':
+        return 'webp'
+    try:
+        _decode_raw(data)
+        return 'raw'
+    except SerializationError:
+        return None
+
+class LazyImage(object):
+    """An encoded image, deserialized with the internal format lazy, that is
+    only decoded when its pixels are first accessed (through array, indexing,
+    or numpy.asarray()).
+    
+    Serializing a LazyImage into its original wire format sends the original
+    bytes without decoding or re-encoding them, unless it was deserialized
+    with the reduce or roi parameters."""
+    def __init__(self,data,wire_format,parent=Image):
+        self.data = data
+        self.wire_format = wire_format
+        self._parent = parent
+        self._array = None
+    
+    @property
+    def is_original(self):
+        """True if the pixels are exactly the image encoded in data."""
+        params = self._parent.PARAMETER_DICT
+        return params.get('reduce',1) == 1 and not params.get('roi')
+    
+    @property
+    def decoded(self):
+        return self._array is not None
+    
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = NumpyImageTranslator.deserialize(self._parent,self.data,self.wire_format,'numpy')
+        return self._array
+    
+    @property
+    def shape(self):
+        return self.array.shape
+    
+    @property
+    def dtype(self):
+        return self.array.dtype
+    
+    def __array__(self,dtype=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+    
+    def __getitem__(self,key):
+        return self.array[key]
+    
+    def __len__(self):
+        return len(self.array)
+    
+    def __repr__(self):
+        return 'LazyImage(%s, %d bytes%s)' % (self.wire_format, len(self.data), ', decoded' if self.decoded else '')
+
+# Internal formats for decoding at reduced resolution, and their scale factors
+_REDUCED_FORMATS = {'numpy': 1, 'numpy_half': 2, 'numpy_quarter': 4, 'numpy_eighth': 8}
+
+class NumpyImageTranslator(Translator):
+    """Translator for images as numpy arrays.
+    
+    The raw wire format sends the height, width, number of channels (0
+    for single-channel 2D images), and dtype, followed by the pixels. It
+    is decoded into an array over the received buffer without a codec or
+    a copy, which suits same-host and high-bandwidth links. The numpy wire
+    format is the .npy format, also decoded without a copy. Neither needs
+    OpenCV, which is only imported when a codec is first used.
+    
+    OpenCV releases the GIL while encoding and decoding, so the images in
+    a list are encoded and decoded on a thread pool of THREADS threads,
+    or of the size given by the parameter threads=<n>.
+    
+    The parameters quality=<0-100> (jpg and webp) and png_level=<0-9>
+    are passed to the encoder; OpenCV's defaults are used otherwise.
+    
+    The internal formats numpy_half, numpy_quarter, and numpy_eighth, or
+    the parameter reduce=<2|4|8>, decode at reduced resolution using
+    OpenCV's IMREAD_REDUCED_COLOR_* modes, which always produce 8-bit
+    color images (raw images are subsampled as a view instead). The
+    parameter roi=<x>:<y>:<width>:<height>, in full-resolution pixels,
+    returns a view of that region of the decoded image.
+    
+    The internal format lazy deserializes into a LazyImage, which keeps
+    the encoded bytes and decodes them on first access.
+    
+    Encoded images are cached if ENCODE_CACHE is set to an
+    EncodedImageCache."""
+    _REDUCED_FLAGS = {2: 'IMREAD_REDUCED_COLOR_2', 4: 'IMREAD_REDUCED_COLOR_4', 8: 'IMREAD_REDUCED_COLOR_8'}
+    _reduced_decode = None
+    
+    @classmethod
+    def _has_reduced_decode(cls):
+        """Older OpenCV versions ignore the reduced modes in imdecode;
+        for those, images are decoded in full and then resized."""
+        if cls._reduced_decode is None:
+            cv2 = _get_cv2()
+            _, b = cv2.imencode('.png', numpy.zeros((16,16),dtype=numpy.uint8))
+            mat = cv2.imdecode(b, getattr(cv2,cls._REDUCED_FLAGS[2]))
+            cls._reduced_decode = mat is not None and mat.shape[0] == 8
+        return cls._reduced_decode
+    
+    @classmethod
+    def known_wire_formats(cls,parent):
+        return ['jpg','png','bmp','webp','numpy','raw']
+
+    @classmethod
+    def known_internal_formats(cls,parent):
+        return ['numpy','numpy_half','numpy_quarter','numpy_eighth','lazy']
+
+    @classmethod
+    def choose_wire_format(cls,parent,data,is_list=False):
+        if isinstance(data,LazyImage):
+            return data.wire_format
+        if not _has_cv2():
+            return 'raw'
+        return super(NumpyImageTranslator,cls).choose_wire_format(parent,data,is_list=is_list)
+
+    @classmethod
+    def extension_for_format(cls,format):
+        return '.' + format
+
+    @classmethod
+    def encode_params(cls,parent,wire_format):
+        params = []
+        quality = parent.PARAMETER_DICT.get('quality')
+        if quality is not None and wire_format == 'jpg':
+            params += [_cv_flag('IMWRITE_JPEG_QUALITY','CV_IMWRITE_JPEG_QUALITY'), quality]
+        elif quality is not None and wire_format == 'webp':
+            params += [_cv_flag('IMWRITE_WEBP_QUALITY','CV_IMWRITE_WEBP_QUALITY'), max(quality,1)]
+        png_level = parent.PARAMETER_DICT.get('png_level')
+        if png_level is not None and wire_format == 'png':
+            params += [_cv_flag('IMWRITE_PNG_COMPRESSION','CV_IMWRITE_PNG_COMPRESSION'), png_level]
+        return params
+    
+    @classmethod
+    def is_binary(cls,parent,wire_format):
+        return True
+    
+    @classmethod
+    def list_map(cls,parent,wire_format):
+        if wire_format in _NUMPY_FORMATS:
+            return None
+        threads = parent.PARAMETER_DICT.get('threads',THREADS)
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        threads = int(threads)
+        if threads <= 1:
+            return None
+        return _get_pool(threads).map
+
+    @classmethod
+    def _decode(cls,parent,data,wire_format,internal_format):
+        """Decodes the image at the resolution and region requested by
+        the internal format and parameters. Returns None if the data
+        cannot be decoded."""
+        reduce = _REDUCED_FORMATS.get(internal_format,1)
+        if reduce == 1:
+            reduce = parent.PARAMETER_DICT.get('reduce',1)
+        if wire_format in _NUMPY_FORMATS:
+            if wire_format == 'raw':
+                mat = _decode_raw(data)
             else:
-                wire_format = cls.known_wire_formats(parent)[0]
-                _, mat = cv2.imencode(cls.extension_for_format(wire_format), mat)
-                b = bytearray(mat.tostring())
-                return b
-
-        @classmethod
-        def serialize(cls,parent,data,internal_format,wire_format):
-            if is_file_like(data) or isinstance(data,str):
-                #TODO: figure out format, convert if necessary
-                return data
-            data = numpy.array(data)
-            _, mat = cv2.imencode(cls.extension_for_format(wire_format), data)
+                try:
+                    mat = _load_npy(data)
+                except ValueError:
+                    return None
+            if reduce > 1:
+                mat = mat[::reduce,::reduce]
+        else:
+            cv2 = _get_cv2()
+            if reduce > 1 and cls._has_reduced_decode():
+                flags = getattr(cv2,cls._REDUCED_FLAGS[reduce])
+            elif reduce > 1:
+                flags = _cv_flag('IMREAD_COLOR','CV_LOAD_IMAGE_COLOR')
+            else:
+                flags = _cv_flag('IMREAD_UNCHANGED','CV_LOAD_IMAGE_UNCHANGED')
+            mat = cv2.imdecode(numpy.frombuffer(data,dtype=numpy.uint8), flags = flags)
+            if reduce > 1 and mat is not None and not cls._has_reduced_decode():
+                size = (-(-mat.shape[1] // reduce), -(-mat.shape[0] // reduce))
+                mat = cv2.resize(mat, size, interpolation = cv2.INTER_AREA)
+        if mat is None or len(mat) == 0:
+            return None
+        roi = parent.PARAMETER_DICT.get('roi')
+        if roi:
+            x, y, w, h = _parse_roi(roi)
+            mat = mat[y//reduce:-(-(y+h)//reduce),x//reduce:-(-(x+w)//reduce)]
+        return mat
+
+    @classmethod
+    def affinity_key(cls,parent,data):
+        return None
+    
+    @classmethod
+    def sniff_wire_format(cls,parent,data,internal_format):
+        return _sniff_format(data)
+
+    @classmethod
+    def deserialize(cls,parent,data,wire_format,internal_format,out=None):
+        if internal_format == 'lazy':
+            if out is not None:
+                raise SerializationError('Internal format lazy does not support an output buffer')
+            return LazyImage(data,wire_format,parent)
+        mat = cls._decode(parent,data,wire_format,internal_format)
+        if mat is None:
+            raise SerializationError()
+        if internal_format in _REDUCED_FORMATS:
+            if out is not None:
+                if out.shape != mat.shape:
+                    raise SerializationError('Output buffer has shape %s, but the image has shape %s' % (out.shape, mat.shape))
+                out[...] = mat
+                return out
+            return mat
+        else:
+            _, mat = _get_cv2().imencode(cls.extension_for_format(wire_format), mat)
+            b = bytearray(mat.tostring())
+            return b
+
+    @classmethod
+    def attempt_deserialize(cls,parent,data,internal_format):
+        if internal_format == 'lazy':
+            return None
+        try:
+            return cls.deserialize(parent,data,'raw',internal_format)
+        except SerializationError:
+            pass
+        if not _has_cv2():
+            return None
+        mat = cls._decode(parent,data,None,internal_format)
+        if mat is None:
+            return None
+        if internal_format in _REDUCED_FORMATS:
+            return mat
+        else:
+            wire_format = cls.known_wire_formats(parent)[0]
+            _, mat = cv2.imencode(cls.extension_for_format(wire_format), mat)
             b = bytearray(mat.tostring())
             return b
-    Image.add_translator(NumpyImageTranslator)
+
+    @classmethod
+    def serialize(cls,parent,data,internal_format,wire_format):
+        if is_file_like(data) or isinstance(data,str):
+            #TODO: figure out format, convert if necessary
+            return data
+        if isinstance(data,LazyImage):
+            if data.wire_format == wire_format and data.is_original:
+                return data.data
+            data = data.array
+        if wire_format == 'raw':
+            return _encode_raw(data)
+        elif wire_format == 'numpy':
+            return _encode_numpy(data)
+        cv2 = _get_cv2()
+        data = numpy.asarray(data)
+        params = cls.encode_params(parent,wire_format)
+        cache = ENCODE_CACHE
+        if cache is not None:
+            key = cache.key(data,wire_format,params)
+            encoded = cache.get(key)
+            if encoded is not None:
+                return bytearray(encoded)
+        _, mat = cv2.imencode(cls.extension_for_format(wire_format), data, params)
+        b = bytearray(mat.tostring())
+        if cache is not None:
+            cache.put(key,mat.tostring())
+        return b
+
+Image.add_translator(NumpyImageTranslator)
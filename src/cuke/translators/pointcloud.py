@@ -0,0 +1,383 @@
+from __future__ import absolute_import
+
+import re, struct, zlib
+from cStringIO import StringIO
+from ..serializer import Translator, SerializationError, is_file_like
+from ..serializers import PointCloud
+from ..util import lzf
+
+import numpy
+
+_DATA_PATTERN = re.compile(r'^DATA[ \t]+(\S+)[ \t]*\r?$', re.MULTILINE)
+_TYPE_KINDS = {'F': 'f', 'I': 'i', 'U': 'u'}
+_KIND_TYPES = {'f': 'F', 'i': 'I', 'u': 'U'}
+_DEFAULT_VIEWPOINT = '0 0 0 1 0 0 0'
+
+# Compressed sizes in front of compressed point data
+_COMPRESSED_SIZES = struct.Struct('<II')
+
+# DATA layouts for the compressed wire formats. binary_zlib is not part of
+# the PCD specification; it has the same layout as binary_compressed, but
+# with zlib instead of LZF.
+_COMPRESSED_LAYOUTS = {'pcd.binary_compressed': 'binary_compressed', 'pcd.zlib': 'binary_zlib'}
+
+def _parse_header(data):
+    """Parses the header of PCD data, returning a dict of the header fields
+    (as lists of strings) and the offset of the point data."""
+    head = str(data[:4096])
+    match = _DATA_PATTERN.search(head)
+    while match is None and len(head) < len(data):
+        head = str(data[:2*len(head)])
+        match = _DATA_PATTERN.search(head)
+    if match is None:
+        raise SerializationError('PCD data has no DATA line')
+    header = {}
+    for line in head[:match.start()].splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        values = line.split()
+        header[values[0].upper()] = values[1:]
+    header['DATA'] = [match.group(1).lower()]
+    offset = match.end()
+    if head[offset:offset+1] == '\n':
+        offset += 1
+    for key in ['FIELDS','SIZE','TYPE']:
+        if key not in header:
+            raise SerializationError('PCD header is missing %s' % key)
+    return header, offset
+
+def _is_real_file(data):
+    try:
+        data.fileno()
+        return True
+    except (AttributeError, IOError, ValueError):
+        return False
+
+def _read_file_header(f):
+    """Reads the header of PCD data from a file-like object, returning the
+    header and the absolute offset of the point data, and leaving the file
+    positioned at the point data."""
+    start = f.tell()
+    head = ''
+    size = 4096
+    while True:
+        chunk = f.read(size - len(head))
+        head += chunk
+        try:
+            header, offset = _parse_header(head)
+        except SerializationError:
+            if not chunk:
+                raise
+            size *= 2
+            continue
+        f.seek(start + offset)
+        return header, start + offset
+
+def _header_dtype(header):
+    """Returns the structured dtype of the points described by a PCD header.
+    Fields with repeated names (e.g. the padding field _) are numbered."""
+    names = header['FIELDS']
+    sizes = [int(s) for s in header['SIZE']]
+    types = header['TYPE']
+    counts = [int(c) for c in header.get('COUNT',['1']*len(names))]
+    if not len(names) == len(sizes) == len(types) == len(counts):
+        raise SerializationError('PCD header FIELDS, SIZE, TYPE, and COUNT have different lengths')
+    fields = []
+    seen = {}
+    for name, size, type_, count in zip(names, sizes, types, counts):
+        if name in seen:
+            seen[name] += 1
+            name = '%s%d' % (name, seen[name])
+        else:
+            seen[name] = 0
+        kind = _TYPE_KINDS.get(type_.upper())
+        if kind is None:
+            raise SerializationError('Unknown PCD field type %s' % type_)
+        dtype = numpy.dtype('<%s%d' % (kind, size))
+        fields.append((name, dtype, (count,)) if count > 1 else (name, dtype))
+    return numpy.dtype(fields)
+
+def _header_shape(header):
+    width = int(header.get('WIDTH',[0])[0])
+    height = int(header.get('HEIGHT',[1])[0])
+    points = int(header.get('POINTS',[width*height])[0])
+    if height > 1 and width * height == points:
+        return points, (height, width)
+    return points, (points,)
+
+def _decode_binary(data, dtype, points, offset):
+    if len(data) - offset < points * dtype.itemsize:
+        raise SerializationError('PCD binary data has %d bytes, expected %d' % (len(data) - offset, points * dtype.itemsize))
+    return numpy.frombuffer(data, dtype=dtype, count=points, offset=offset)
+
+def _decode_ascii(data, dtype, points, offset):
+    values = numpy.fromstring(str(data[offset:]), dtype=numpy.float64, sep=' ')
+    columns = sum(_field_count(dtype, name) for name in dtype.names)
+    if len(values) != points * columns:
+        raise SerializationError('PCD ascii data has %d values, expected %d' % (len(values), points * columns))
+    values = values.reshape((points, columns))
+    cloud = numpy.empty((points,), dtype=dtype)
+    col = 0
+    for name in dtype.names:
+        count = _field_count(dtype, name)
+        field = cloud[name]
+        field[...] = values[:,col:col+count].reshape(field.shape)
+        col += count
+    return cloud
+
+def _decode_compressed(data, dtype, points, offset, data_format):
+    """Decodes compressed point data, which holds the values of each field
+    for all points in turn (i.e. in columns)."""
+    try:
+        compressed_size, size = _COMPRESSED_SIZES.unpack_from(data, offset)
+    except struct.error:
+        raise SerializationError('PCD compressed data is truncated')
+    offset += _COMPRESSED_SIZES.size
+    compressed = str(data[offset:offset+compressed_size])
+    if len(compressed) != compressed_size:
+        raise SerializationError('PCD compressed data is truncated')
+    if size != points * dtype.itemsize:
+        raise SerializationError('PCD compressed data has %d bytes, expected %d' % (size, points * dtype.itemsize))
+    cloud = numpy.empty((points,), dtype=dtype)
+    if not size:
+        return cloud
+    try:
+        if data_format == 'binary_zlib':
+            columns = zlib.decompress(compressed)
+        else:
+            columns = lzf.decompress(compressed, size)
+    except (zlib.error, lzf.LZFError) as e:
+        raise SerializationError('PCD compressed data is corrupt: %s' % e)
+    column_offset = 0
+    for name in dtype.names:
+        field = cloud[name]
+        field[...] = numpy.frombuffer(columns, dtype=field.dtype, count=field.size, offset=column_offset).reshape(field.shape)
+        column_offset += field.nbytes
+    return cloud
+
+def _encode_compressed(cloud, dtype, data_format):
+    cloud = cloud.reshape((cloud.size,))
+    columns = b''.join(numpy.ascontiguousarray(cloud[name], dtype=dtype.fields[name][0].base).tostring() for name in dtype.names)
+    if data_format == 'binary_zlib':
+        compressed = zlib.compress(columns, 1)
+    else:
+        compressed = lzf.compress(columns)
+    return _COMPRESSED_SIZES.pack(len(compressed), len(columns)) + compressed
+
+def _field_count(dtype, name):
+    shape = dtype.fields[name][0].shape
+    return int(numpy.prod(shape)) if shape else 1
+
+def _as_structured(data):
+    """Returns the given array as a structured array of points, converting
+    unstructured arrays of shape (N,3) or (N,4) to fields x, y, z (and
+    intensity)."""
+    data = numpy.asarray(data)
+    if data.dtype.names:
+        return data
+    if data.ndim != 2 or data.shape[1] not in (3,4):
+        raise SerializationError('Point clouds must be structured arrays or arrays of shape (N,3) or (N,4)')
+    names = ['x','y','z','intensity'][:data.shape[1]]
+    dtype = data.dtype if data.dtype.kind == 'f' else numpy.dtype(numpy.float32)
+    cloud = numpy.empty((len(data),), dtype=[(name, dtype) for name in names])
+    for idx, name in enumerate(names):
+        cloud[name] = data[:,idx]
+    return cloud
+
+def _stride_downsample(cloud, stride):
+    """Keeps every stride-th point, or every stride-th row and column of an
+    organized cloud."""
+    if cloud.ndim == 2:
+        return cloud[::stride,::stride]
+    return cloud[::stride]
+
+def _voxel_downsample(cloud, voxel):
+    """Replaces the points in each voxel of the given size with their
+    centroid. Fields other than x, y, and z are taken from the first point
+    in the voxel, and points with non-finite coordinates are dropped."""
+    cloud = cloud.reshape((cloud.size,))
+    if not all(name in cloud.dtype.names for name in 'xyz'):
+        raise SerializationError('Voxel downsampling requires x, y, and z fields')
+    xyz = numpy.column_stack([cloud[name].astype(numpy.float64) for name in 'xyz'])
+    finite = numpy.isfinite(xyz).all(axis=1)
+    if not finite.all():
+        cloud = cloud[finite]
+        xyz = xyz[finite]
+    if not len(cloud):
+        return cloud
+    keys = numpy.floor(xyz / voxel).astype(numpy.int64)
+    keys -= keys.min(axis=0)
+    dims = keys.max(axis=0) + 1
+    if numpy.prod(dims.astype(numpy.float64)) < 2**62:
+        linear = numpy.ravel_multi_index(keys.T, dims)
+        _, first, inverse = numpy.unique(linear, return_index=True, return_inverse=True)
+    else:
+        _, first, inverse = numpy.unique(keys, axis=0, return_index=True, return_inverse=True)
+    counts = numpy.bincount(inverse).astype(numpy.float64)
+    reduced = cloud[first]
+    for idx, name in enumerate('xyz'):
+        reduced[name] = numpy.bincount(inverse, weights=xyz[:,idx]) / counts
+    return reduced
+
+def _pcd_header(cloud, data_format, viewpoint=None):
+    """Returns the header for the given structured array and the
+    little-endian dtype its points are written with."""
+    names, sizes, types, counts, fields = [], [], [], [], []
+    for name in cloud.dtype.names:
+        field_dtype, _ = cloud.dtype.fields[name][:2]
+        base = field_dtype.base
+        if base.kind not in _KIND_TYPES:
+            raise SerializationError('Point cloud field %s has unsupported type %s' % (name, base))
+        count = _field_count(cloud.dtype, name)
+        names.append(name)
+        sizes.append(str(base.itemsize))
+        types.append(_KIND_TYPES[base.kind])
+        counts.append(str(count))
+        le = base.newbyteorder('<')
+        fields.append((name, le, (count,)) if count > 1 else (name, le))
+    if cloud.ndim == 2:
+        height, width = cloud.shape
+    else:
+        height, width = 1, cloud.size
+    lines = ['# .PCD v0.7 - Point Cloud Data file format',
+             'VERSION 0.7',
+             'FIELDS ' + ' '.join(names),
+             'SIZE ' + ' '.join(sizes),
+             'TYPE ' + ' '.join(types),
+             'COUNT ' + ' '.join(counts),
+             'WIDTH %d' % width,
+             'HEIGHT %d' % height,
+             'VIEWPOINT ' + (viewpoint or _DEFAULT_VIEWPOINT),
+             'POINTS %d' % cloud.size,
+             'DATA ' + data_format]
+    return '\n'.join(lines) + '\n', numpy.dtype(fields)
+
+def _encode_ascii(cloud):
+    columns = []
+    fmt = []
+    for name in cloud.dtype.names:
+        field = cloud[name].reshape((cloud.size, -1))
+        kind = field.dtype.kind
+        columns.append(field.astype(numpy.float64))
+        if kind == 'f':
+            fmt += ['%.17g' if field.dtype.itemsize > 4 else '%.9g'] * field.shape[1]
+        else:
+            fmt += ['%d'] * field.shape[1]
+    sio = StringIO()
+    if cloud.size:
+        numpy.savetxt(sio, numpy.hstack(columns), fmt=fmt, delimiter=' ')
+    return sio.getvalue()
+
+class NumpyPointCloudTranslator(Translator):
+    """Translator for point clouds in the PCD format, as numpy structured
+    arrays with one field per PCD field.
+
+    Binary PCD data is decoded with numpy.frombuffer as a view of the
+    received data, and ascii PCD data is parsed in a single vectorized pass.
+    Organized clouds (HEIGHT > 1) have shape (height, width). The wire format
+    pcd accepts any layout on deserialization and writes binary.
+    pcd.binary_compressed writes the LZF-compressed columnar layout of the
+    PCD specification, and pcd.zlib writes the same layout compressed with
+    zlib (as DATA binary_zlib, which other PCD readers do not understand).
+    Without the python-lzf module, LZF compression runs at a few MB/s, several
+    times slower than zlib.
+    Unstructured arrays of shape (N,3) or (N,4) are serialized with the
+    fields x, y, z (and intensity); ascii values are written through float64.
+
+    Binary PCD data in a file (a file-like object with a file descriptor) is
+    returned as a read-only numpy.memmap over the file, so it is paged in on
+    demand instead of being read into memory.
+
+    The parameters voxel=<size> and stride=<n> downsample clouds when they
+    are serialized, to the centroids of the points in each voxel (of an
+    unorganized cloud) or to every n-th point.
+
+    The internal format raw passes the PCD data through unparsed."""
+
+    @classmethod
+    def known_wire_formats(cls,parent):
+        return ['pcd','pcd.binary','pcd.ascii','pcd.binary_compressed','pcd.zlib']
+
+    @classmethod
+    def known_internal_formats(cls,parent):
+        return ['numpy','raw']
+
+    @classmethod
+    def is_binary(cls,parent,wire_format):
+        return wire_format != 'pcd.ascii'
+
+    @classmethod
+    def can_serialize(cls, parent, data, internal_format, wire_format):
+        if internal_format == 'raw' and not (is_file_like(data) or isinstance(data,(basestring,bytearray))):
+            return False
+        return super(NumpyPointCloudTranslator, cls).can_serialize(parent, data, internal_format, wire_format)
+
+    @classmethod
+    def affinity_key(cls,parent,data):
+        return None
+
+    @classmethod
+    def sniff_wire_format(cls,parent,data,internal_format):
+        if is_file_like(data):
+            start = data.tell()
+            head = data.read(16)
+            data.seek(start)
+        else:
+            head = str(data[:16])
+        head = head.lstrip()
+        if head.startswith('#') or head.upper().startswith('VERSION') or head.upper().startswith('FIELDS'):
+            return 'pcd'
+        return None
+
+    @classmethod
+    def deserialize(cls,parent,data,wire_format,internal_format):
+        if internal_format == 'raw':
+            return data
+        if is_file_like(data):
+            header, offset = _read_file_header(data)
+            if header['DATA'][0] == 'binary' and _is_real_file(data):
+                dtype = _header_dtype(header)
+                points, shape = _header_shape(header)
+                return numpy.memmap(data, dtype=dtype, mode='r', offset=offset, shape=shape)
+            data = data.read()
+            offset = 0
+        else:
+            header, offset = _parse_header(data)
+        dtype = _header_dtype(header)
+        points, shape = _header_shape(header)
+        data_format = header['DATA'][0]
+        if data_format == 'binary':
+            cloud = _decode_binary(data, dtype, points, offset)
+        elif data_format == 'ascii':
+            cloud = _decode_ascii(data, dtype, points, offset)
+        elif data_format in _COMPRESSED_LAYOUTS.values():
+            cloud = _decode_compressed(data, dtype, points, offset, data_format)
+        else:
+            raise SerializationError('Unsupported PCD data layout %s' % data_format)
+        return cloud.reshape(shape)
+
+    @classmethod
+    def serialize(cls,parent,data,internal_format,wire_format):
+        if internal_format == 'raw' or is_file_like(data) or isinstance(data,(str,bytearray)):
+            return data
+        cloud = _as_structured(data)
+        stride = parent.PARAMETER_DICT.get('stride')
+        if stride > 1:
+            cloud = _stride_downsample(cloud, stride)
+        voxel = parent.PARAMETER_DICT.get('voxel')
+        if voxel:
+            cloud = _voxel_downsample(cloud, voxel)
+        if wire_format == 'pcd.ascii':
+            header, _ = _pcd_header(cloud, 'ascii')
+            return header + _encode_ascii(cloud)
+        elif wire_format in _COMPRESSED_LAYOUTS:
+            data_format = _COMPRESSED_LAYOUTS[wire_format]
+            header, dtype = _pcd_header(cloud, data_format)
+            return bytearray(header + _encode_compressed(cloud, dtype, data_format))
+        header, dtype = _pcd_header(cloud, 'binary')
+        b = bytearray(header)
+        b.extend(buffer(numpy.ascontiguousarray(cloud, dtype=dtype)))
+        return b
+
+PointCloud.add_translator(NumpyPointCloudTranslator)
@@ -1086,6 +1086,55 @@ def euler_from_matrix(matrix, axes='sxyz'):
     return ax, ay, az
 
 
+def euler_from_matrix_array(matrices, axes='sxyz'):
+    """Return array of Euler angles from array of rotation matrices.
+
+    matrices : array like of shape (N, 4, 4) or (N, 3, 3)
+    axes : One of 24 axis sequences as string or encoded tuple
+
+    >>> angles = (4.0*math.pi) * (numpy.random.random((10, 3)) - 0.5)
+    >>> for axes in _AXES2TUPLE.keys():
+    ...    R = numpy.array([euler_matrix(axes=axes, *a) for a in angles])
+    ...    e0 = numpy.array([euler_from_matrix(M, axes) for M in R])
+    ...    e1 = euler_from_matrix_array(R, axes)
+    ...    if not numpy.allclose(e0, e1): print axes, "failed"
+    >>> euler_from_matrix_array([numpy.identity(4)]).shape
+    (1, 3)
+
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _ = _TUPLE2AXES[axes]
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis
+    j = _NEXT_AXIS[i+parity]
+    k = _NEXT_AXIS[i-parity+1]
+
+    M = numpy.array(matrices, dtype=numpy.float64, copy=False)[..., :3, :3]
+    if repetition:
+        sy = numpy.sqrt(M[..., i, j]*M[..., i, j] + M[..., i, k]*M[..., i, k])
+        big = sy > _EPS
+        ax = numpy.where(big, numpy.arctan2( M[..., i, j],  M[..., i, k]),
+                              numpy.arctan2(-M[..., j, k],  M[..., j, j]))
+        ay = numpy.arctan2(sy, M[..., i, i])
+        az = numpy.where(big, numpy.arctan2( M[..., j, i], -M[..., k, i]), 0.0)
+    else:
+        cy = numpy.sqrt(M[..., i, i]*M[..., i, i] + M[..., j, i]*M[..., j, i])
+        big = cy > _EPS
+        ax = numpy.where(big, numpy.arctan2( M[..., k, j],  M[..., k, k]),
+                              numpy.arctan2(-M[..., j, k],  M[..., j, j]))
+        ay = numpy.arctan2(-M[..., k, i], cy)
+        az = numpy.where(big, numpy.arctan2( M[..., j, i],  M[..., i, i]), 0.0)
+
+    if parity:
+        ax, ay, az = -ax, -ay, -az
+    if frame:
+        ax, az = az, ax
+    return numpy.stack((ax, ay, az), axis=-1)
+
+
 def euler_from_quaternion(quaternion, axes='sxyz'):
     """Return Euler angles from quaternion for specified axis sequence.
 
@@ -1154,6 +1203,74 @@ def quaternion_from_euler(ai, aj, ak, axes='sxyz'):
     return quaternion
 
 
+def quaternion_from_euler_array(ai, aj, ak, axes='sxyz'):
+    """Return array of quaternions from arrays of Euler angles.
+
+    ai, aj, ak : arrays of Euler's roll, pitch and yaw angles, broadcast
+        against each other
+    axes : One of 24 axis sequences as string or encoded tuple
+
+    >>> angles = (4.0*math.pi) * (numpy.random.random((10, 3)) - 0.5)
+    >>> for axes in _AXES2TUPLE.keys():
+    ...    q0 = numpy.array([quaternion_from_euler(axes=axes, *a)
+    ...                      for a in angles])
+    ...    q1 = quaternion_from_euler_array(axes=axes, *angles.T)
+    ...    if not numpy.allclose(q0, q1): print axes, "failed"
+    >>> quaternion_from_euler_array([1, 2], 2, 3, 'ryxz').shape
+    (2, 4)
+
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _ = _TUPLE2AXES[axes]
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis
+    j = _NEXT_AXIS[i+parity]
+    k = _NEXT_AXIS[i-parity+1]
+
+    ai, aj, ak = numpy.broadcast_arrays(
+        numpy.asarray(ai, dtype=numpy.float64),
+        numpy.asarray(aj, dtype=numpy.float64),
+        numpy.asarray(ak, dtype=numpy.float64))
+
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        aj = -aj
+
+    ai = ai / 2.0
+    aj = aj / 2.0
+    ak = ak / 2.0
+    ci = numpy.cos(ai)
+    si = numpy.sin(ai)
+    cj = numpy.cos(aj)
+    sj = numpy.sin(aj)
+    ck = numpy.cos(ak)
+    sk = numpy.sin(ak)
+    cc = ci*ck
+    cs = ci*sk
+    sc = si*ck
+    ss = si*sk
+
+    quaternion = numpy.empty(ai.shape + (4, ), dtype=numpy.float64)
+    if repetition:
+        quaternion[..., i] = cj*(cs + sc)
+        quaternion[..., j] = sj*(cc + ss)
+        quaternion[..., k] = sj*(cs - sc)
+        quaternion[..., 3] = cj*(cc - ss)
+    else:
+        quaternion[..., i] = cj*sc - sj*cs
+        quaternion[..., j] = cj*ss + sj*cc
+        quaternion[..., k] = cj*cs - sj*sc
+        quaternion[..., 3] = cj*cc + sj*ss
+    if parity:
+        quaternion[..., j] *= -1
+
+    return quaternion
+
+
 def quaternion_about_axis(angle, axis):
     """Return quaternion for rotation about axis.
 
@@ -1225,6 +1342,106 @@ def quaternion_from_matrix(matrix):
     return q
 
 
+def quaternion_matrix_array(quaternions, out=None):
+    """Return array of homogeneous rotation matrices from array of quaternions.
+
+    quaternions : array like of shape (N, 4)
+    out : optional array of shape (N, 4, 4) to write the matrices into
+
+    >>> q = numpy.array([random_quaternion() for _ in range(5)])
+    >>> M = quaternion_matrix_array(q)
+    >>> M.shape
+    (5, 4, 4)
+    >>> all(numpy.allclose(M[i], quaternion_matrix(q[i])) for i in range(5))
+    True
+    >>> M = numpy.empty((2, 4, 4))
+    >>> M is quaternion_matrix_array([[0, 0, 0, 0], [1, 0, 0, 0]], out=M)
+    True
+    >>> numpy.allclose(M[0], numpy.identity(4))
+    True
+
+    """
+    q = numpy.array(quaternions, dtype=numpy.float64, copy=True)
+    q = q.reshape((-1, 4))
+    nq = numpy.sum(q*q, axis=1)
+    small = nq < _EPS
+    nq[small] = 2.0
+    q *= numpy.sqrt(2.0 / nq)[:, numpy.newaxis]
+    q[small] = 0.0
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    if out is None:
+        out = numpy.empty((q.shape[0], 4, 4), dtype=numpy.float64)
+    out[:, 0, 0] = 1.0 - y*y - z*z
+    out[:, 0, 1] = x*y - z*w
+    out[:, 0, 2] = x*z + y*w
+    out[:, 1, 0] = x*y + z*w
+    out[:, 1, 1] = 1.0 - x*x - z*z
+    out[:, 1, 2] = y*z - x*w
+    out[:, 2, 0] = x*z - y*w
+    out[:, 2, 1] = y*z + x*w
+    out[:, 2, 2] = 1.0 - x*x - y*y
+    out[:, 0:3, 3] = 0.0
+    out[:, 3, :] = (0.0, 0.0, 0.0, 1.0)
+    return out
+
+
+def quaternion_from_matrix_array(matrices):
+    """Return array of quaternions from array of rotation matrices.
+
+    matrices : array like of shape (N, 4, 4) or (N, 3, 3)
+
+    >>> R = numpy.array([random_rotation_matrix() for _ in range(20)])
+    >>> R[0] = rotation_matrix(math.pi, (1, 0, 0))
+    >>> R[1] = rotation_matrix(math.pi, (0, 1, 0))
+    >>> R[2] = rotation_matrix(math.pi, (0, 0, 1))
+    >>> q = quaternion_from_matrix_array(R)
+    >>> all(numpy.allclose(q[i], quaternion_from_matrix(R[i]))
+    ...     for i in range(20))
+    True
+    >>> numpy.allclose(q, quaternion_from_matrix_array(R[:, :3, :3]))
+    True
+
+    """
+    M = numpy.array(matrices, dtype=numpy.float64, copy=False)
+    if M.shape[-2:] == (3, 3):
+        m33 = numpy.ones(M.shape[:-2])
+    else:
+        m33 = M[..., 3, 3]
+    M = M.reshape((-1, ) + M.shape[-2:])
+    m33 = m33.reshape(-1)
+    m00, m01, m02 = M[:, 0, 0], M[:, 0, 1], M[:, 0, 2]
+    m10, m11, m12 = M[:, 1, 0], M[:, 1, 1], M[:, 1, 2]
+    m20, m21, m22 = M[:, 2, 0], M[:, 2, 1], M[:, 2, 2]
+    q = numpy.empty((M.shape[0], 4), dtype=numpy.float64)
+    t = m00 + m11 + m22 + m33
+    i = numpy.zeros(M.shape[0], dtype=int)
+    i[m11 > m00] = 1
+    i[m22 > numpy.choose(i, (m00, m11))] = 2
+    # i == 0: j, k = 1, 2
+    c = (i == 0)
+    t[c] = m00[c] - (m11[c] + m22[c]) + m33[c]
+    q[c] = numpy.column_stack((t[c], m01[c] + m10[c], m20[c] + m02[c],
+                               m21[c] - m12[c]))
+    # i == 1: j, k = 2, 0
+    c = (i == 1)
+    t[c] = m11[c] - (m22[c] + m00[c]) + m33[c]
+    q[c] = numpy.column_stack((m01[c] + m10[c], t[c], m12[c] + m21[c],
+                               m02[c] - m20[c]))
+    # i == 2: j, k = 0, 1
+    c = (i == 2)
+    t[c] = m22[c] - (m00[c] + m11[c]) + m33[c]
+    q[c] = numpy.column_stack((m20[c] + m02[c], m12[c] + m21[c], t[c],
+                               m10[c] - m01[c]))
+    # trace is largest
+    tr = m00 + m11 + m22 + m33
+    c = tr > m33
+    t[c] = tr[c]
+    q[c] = numpy.column_stack((m21[c] - m12[c], m02[c] - m20[c],
+                               m10[c] - m01[c], t[c]))
+    q *= (0.5 / numpy.sqrt(t * m33))[:, numpy.newaxis]
+    return q
+
+
 def quaternion_multiply(quaternion1, quaternion0):
     """Return multiplication of two quaternions.
 
@@ -1242,6 +1459,33 @@ def quaternion_multiply(quaternion1, quaternion0):
         -x1*x0 - y1*y0 - z1*z0 + w1*w0), dtype=numpy.float64)
 
 
+def quaternion_multiply_array(quaternion1, quaternion0):
+    """Return multiplication of two arrays of quaternions.
+
+    The arrays of shape (N, 4) or (4, ) are broadcast against each other.
+
+    >>> q0 = numpy.array([random_quaternion() for _ in range(5)])
+    >>> q1 = numpy.array([random_quaternion() for _ in range(5)])
+    >>> q = quaternion_multiply_array(q1, q0)
+    >>> all(numpy.allclose(q[i], quaternion_multiply(q1[i], q0[i]))
+    ...     for i in range(5))
+    True
+    >>> q = quaternion_multiply_array([1, -2, 3, 4], [[-5, 6, 7, 8]])
+    >>> numpy.allclose(q, [[-44, -14, 48, 28]])
+    True
+
+    """
+    q0 = numpy.asarray(quaternion0, dtype=numpy.float64)
+    q1 = numpy.asarray(quaternion1, dtype=numpy.float64)
+    x0, y0, z0, w0 = q0[..., 0], q0[..., 1], q0[..., 2], q0[..., 3]
+    x1, y1, z1, w1 = q1[..., 0], q1[..., 1], q1[..., 2], q1[..., 3]
+    return numpy.stack((
+         x1*w0 + y1*z0 - z1*y0 + w1*x0,
+        -x1*z0 + y1*w0 + z1*x0 + w1*y0,
+         x1*y0 - y1*x0 + z1*w0 + w1*z0,
+        -x1*x0 - y1*y0 - z1*z0 + w1*w0), axis=-1)
+
+
 def quaternion_conjugate(quaternion):
     """Return conjugate of quaternion.
 
@@ -1308,6 +1552,48 @@ def quaternion_slerp(quat0, quat1, fraction, spin=0, shortestpath=True):
     return q0
 
 
+def quaternion_slerp_array(quat0, quat1, fraction, spin=0, shortestpath=True):
+    """Return spherical linear interpolation between two arrays of quaternions.
+
+    The quaternion arrays of shape (N, 4) or (4, ) and the fractions of
+    shape (N, ) or scalar are broadcast against each other.
+
+    >>> q0 = numpy.array([random_quaternion() for _ in range(5)])
+    >>> q1 = numpy.array([random_quaternion() for _ in range(5)])
+    >>> f = numpy.array([0.0, 0.25, 0.5, 0.75, 1.0])
+    >>> q = quaternion_slerp_array(q0, q1, f)
+    >>> all(numpy.allclose(q[i], quaternion_slerp(q0[i], q1[i], f[i]))
+    ...     for i in range(5))
+    True
+    >>> q = quaternion_slerp_array(q0, q0, 0.5)
+    >>> numpy.allclose(q, q0)
+    True
+
+    """
+    q0 = numpy.array(quat0, dtype=numpy.float64, copy=True)[..., :4]
+    q1 = numpy.array(quat1, dtype=numpy.float64, copy=True)[..., :4]
+    q0 /= numpy.sqrt(numpy.sum(q0*q0, axis=-1))[..., numpy.newaxis]
+    q1 /= numpy.sqrt(numpy.sum(q1*q1, axis=-1))[..., numpy.newaxis]
+    fraction = numpy.asarray(fraction, dtype=numpy.float64)
+    d = numpy.sum(q0*q1, axis=-1)
+    degenerate = numpy.abs(numpy.abs(d) - 1.0) < _EPS
+    q1s = q1
+    if shortestpath:
+        # invert rotation
+        flip = d < 0.0
+        d = numpy.where(flip, -d, d)
+        q1s = numpy.where(flip[..., numpy.newaxis], -q1, q1)
+    angle = numpy.arccos(numpy.clip(d, -1.0, 1.0)) + spin * math.pi
+    degenerate = degenerate | (numpy.abs(angle) < _EPS)
+    isin = 1.0 / numpy.where(degenerate, 1.0, numpy.sin(angle))
+    w0 = numpy.where(degenerate, 1.0, numpy.sin((1.0 - fraction) * angle) * isin)
+    w1 = numpy.where(degenerate, 0.0, numpy.sin(fraction * angle) * isin)
+    q = q0 * w0[..., numpy.newaxis] + q1s * w1[..., numpy.newaxis]
+    q = numpy.where((fraction == 0.0)[..., numpy.newaxis], q0, q)
+    q = numpy.where((fraction == 1.0)[..., numpy.newaxis], q1, q)
+    return q
+
+
 def random_quaternion(rand=None):
     """Return uniform random unit quaternion.
 
@@ -1646,6 +1932,18 @@ def inverse_matrix(matrix):
     return numpy.linalg.inv(matrix)
 
 
+def inverse_matrix_array(matrices):
+    """Return inverses of an array of square transformation matrices.
+
+    >>> M0 = numpy.array([random_rotation_matrix() for _ in range(5)])
+    >>> M1 = inverse_matrix_array(M0)
+    >>> all(numpy.allclose(M1[i], inverse_matrix(M0[i])) for i in range(5))
+    True
+
+    """
+    return numpy.linalg.inv(numpy.asarray(matrices))
+
+
 def concatenate_matrices(*matrices):
     """Return concatenation of series of transformation matrices.
 
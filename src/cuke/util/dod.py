@@ -0,0 +1,79 @@
+"""Delta-of-delta encoding of int64 sequences, such as timestamps.
+
+The encoding is a little-endian uint32 count and int64 first value, followed
+by the first difference and then the differences of consecutive differences,
+each zigzag-encoded as an unsigned varint. Regularly spaced sequences encode
+to about one byte per value. Encoding and decoding are vectorized with numpy.
+"""
+from __future__ import absolute_import
+
+__all__ = ["encode", "decode", "DODError"]
+
+import struct
+
+import numpy
+
+_HEADER = struct.Struct('<Iq')
+
+# An unsigned 64-bit varint has at most 10 bytes of 7 bits
+_MAX_VARINT_BYTES = 10
+
+class DODError(ValueError):
+    """Raised when delta-of-delta data is corrupt"""
+
+def _encode_varints(z):
+    if not len(z):
+        return b''
+    width = max(1, (int(z.max()).bit_length() + 6) // 7)
+    shifts = numpy.arange(width, dtype=numpy.uint64) * numpy.uint64(7)
+    groups = (z[:,numpy.newaxis] >> shifts) & numpy.uint64(0x7f)
+    # Each value needs bytes up to its highest nonzero group, and at least one
+    nonzero = groups != 0
+    nbytes = width - numpy.argmax(nonzero[:,::-1], axis=1)
+    nbytes[~nonzero.any(axis=1)] = 1
+    used = numpy.arange(width) < nbytes[:,numpy.newaxis]
+    out = groups.astype(numpy.uint8)
+    out[:,:-1][used[:,1:]] |= 0x80
+    return out[used].tobytes()
+
+def _decode_varints(b, count):
+    ends = numpy.flatnonzero(b < 0x80)
+    if len(ends) != count or (count and ends[-1] != len(b) - 1):
+        raise DODError("Delta-of-delta data does not hold %d varints" % count)
+    if not count:
+        return numpy.zeros((0,), dtype=numpy.uint64)
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    if (ends - starts).max() >= _MAX_VARINT_BYTES:
+        raise DODError("Delta-of-delta varint longer than %d bytes" % _MAX_VARINT_BYTES)
+    position = numpy.arange(len(b)) - numpy.repeat(starts, ends - starts + 1)
+    groups = (b & 0x7f).astype(numpy.uint64) << (position * 7).astype(numpy.uint64)
+    return numpy.add.reduceat(groups, starts)
+
+def encode(values):
+    """Encodes a sequence of int64 values."""
+    values = numpy.asarray(values, dtype=numpy.int64).ravel()
+    n = len(values)
+    if not n:
+        return _HEADER.pack(0, 0)
+    dods = numpy.diff(values)
+    dods[1:] = numpy.diff(dods)
+    z = ((dods << 1) ^ (dods >> 63)).view(numpy.uint64)
+    return _HEADER.pack(n, values[0]) + _encode_varints(z)
+
+def decode(data):
+    """Decodes data produced by encode() into an int64 array."""
+    if len(data) < _HEADER.size:
+        raise DODError("Delta-of-delta data is too short")
+    n, first = _HEADER.unpack_from(data)
+    values = numpy.empty((n,), dtype=numpy.int64)
+    if not n:
+        return values
+    z = _decode_varints(numpy.frombuffer(data, dtype=numpy.uint8)[_HEADER.size:], n - 1)
+    dods = (z >> numpy.uint64(1)).view(numpy.int64) ^ -(z & numpy.uint64(1)).view(numpy.int64)
+    values[0] = first
+    numpy.cumsum(dods, out=dods)
+    numpy.cumsum(dods, out=values[1:])
+    values[1:] += first
+    return values
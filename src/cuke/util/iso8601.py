@@ -85,22 +85,41 @@ class FixedOffset(tzinfo):
     def __repr__(self):
         return "<FixedOffset %r>" % self.__name
 
+# FixedOffset instances by time zone string, shared between parsed dates
+_FIXED_OFFSETS = {}
+
+def _fixed_offset(hours, minutes, name):
+    tz = _FIXED_OFFSETS.get(name)
+    if tz is None:
+        if len(_FIXED_OFFSETS) > 1024:
+            _FIXED_OFFSETS.clear()
+        tz = _FIXED_OFFSETS[name] = FixedOffset(hours, minutes, name)
+    return tz
+
+# The local time zone and the time until which it is valid. It is refreshed
+# at the next quarter hour, the granularity of daylight saving transitions.
+_LOCAL_TIMEZONE = [None, 0]
+
 def local_timezone():
     import time
     t = time.time()
+    if t < _LOCAL_TIMEZONE[1]:
+        return _LOCAL_TIMEZONE[0]
     dt_local = datetime.fromtimestamp(t)
     dt_utc = datetime.utcfromtimestamp(t)
     diff = (dt_local - dt_utc).total_seconds() / 3600.
     negative = diff < 0
     diff = abs(diff)
     hours = int(diff)
-    minutes = int((diff-hours) * 60)
+    minutes = int(round((diff-hours) * 60))
     name = '%02d:%02d' % (hours, minutes)
     if negative:
         hours = -hours
         minutes = -minutes
         name = '-' + name
-    return FixedOffset(hours, minutes, name)
+    tz = _fixed_offset(hours, minutes, name)
+    _LOCAL_TIMEZONE[:] = [tz, (int(t) // 900 + 1) * 900]
+    return tz
 
 def parse_timezone(tzstring, default_timezone=None):
     """Parses ISO 8601 time zone specs into tzinfo offsets
@@ -113,6 +132,9 @@ def parse_timezone(tzstring, default_timezone=None):
     # Addresses issue 4.
     if tzstring is None:
         return default_timezone
+    tz = _FIXED_OFFSETS.get(tzstring)
+    if tz is not None:
+        return tz
     m = TIMEZONE_REGEX.match(tzstring)
     if not m:
         raise ParseError("Unable to parse time zone string %r" % tzstring)
@@ -121,7 +143,39 @@ def parse_timezone(tzstring, default_timezone=None):
     if prefix == "-":
         hours = -hours
         minutes = -minutes
-    return FixedOffset(hours, minutes, tzstring)
+    return _fixed_offset(hours, minutes, tzstring)
+
+def _parse_fixed_layout(datestring, default_timezone):
+    """Parses dates in the common layout YYYY-MM-DDTHH:MM:SS[.f][Z|+HH:MM]
+    by slicing. Returns None for dates in any other layout."""
+    n = len(datestring)
+    if (n < 19 or datestring[4] != '-' or datestring[7] != '-'
+            or datestring[13] != ':' or datestring[16] != ':'):
+        return None
+    if datestring[-1] == 'Z':
+        tz = UTC
+        n -= 1
+    elif n >= 25 and datestring[-3] == ':' and datestring[-6] in '+-':
+        tz = _FIXED_OFFSETS.get(datestring[-6:]) or parse_timezone(datestring[-6:])
+        n -= 6
+    else:
+        tz = default_timezone
+    if n == 19:
+        microsecond = 0
+    elif datestring[19] == '.' and n > 20:
+        fraction = datestring[20:n]
+        if not fraction.isdigit():
+            return None
+        microsecond = int(fraction[:6]) * _FRACTION_SCALE[min(len(fraction),6)]
+    else:
+        return None
+    if not (datestring[0:4] + datestring[5:7] + datestring[8:10] + datestring[11:13]
+            + datestring[14:16] + datestring[17:19]).isdigit():
+        return None
+    return datetime(int(datestring[0:4]), int(datestring[5:7]), int(datestring[8:10]),
+        int(datestring[11:13]), int(datestring[14:16]), int(datestring[17:19]), microsecond, tz)
+
+_FRACTION_SCALE = [0, 100000, 10000, 1000, 100, 10, 1]
 
 def parse_date(datestring, default_timezone=None):
     """Parses ISO 8601 dates into datetime objects
@@ -129,16 +183,25 @@ def parse_date(datestring, default_timezone=None):
     The timezone is parsed from the date string. However it is quite common to
     have dates without a timezone. In this case the default timezone specified 
     in default_timezone, if any, is used.
+    
+    Dates in the layout YYYY-MM-DDTHH:MM:SS[.ffffff][Z|+HH:MM] are parsed
+    without the regex, which handles all other layouts.
     """
     if isinstance(default_timezone, basestring):
         if default_timezone.upper() == 'UTC':
             default_timezone = UTC
         elif default_timezone.lower() == 'local':
-            tzinfo = local_timezone()
+            default_timezone = local_timezone()
         else:
             default_timezone = parse_timezone(default_timezone)
     if not isinstance(datestring, basestring):
         raise ParseError("Expecting a string %r" % datestring)
+    try:
+        dt = _parse_fixed_layout(datestring, default_timezone)
+    except ParseError:
+        dt = None
+    if dt is not None:
+        return dt
     m = ISO8601_REGEX.match(datestring)
     if not m:
         raise ParseError("Unable to parse date string %r" % datestring)
@@ -152,31 +215,49 @@ def parse_date(datestring, default_timezone=None):
         int(groups["hour"]), int(groups["minute"]), int(groups["second"]),
         int(groups["fraction"]), tz)
 
+# ISO 8601 suffixes by UTC offset in seconds
+_TZ_SUFFIXES = {0: 'Z'}
+
+def _tz_suffix(tzinfo, dt):
+    offset = tzinfo.utcoffset(dt)
+    offset = offset.days * 86400 + offset.seconds
+    suffix = _TZ_SUFFIXES.get(offset)
+    if suffix is None:
+        minutes = abs(offset) // 60
+        suffix = _TZ_SUFFIXES[offset] = '%s%02d:%02d' % ('-' if offset < 0 else '+', minutes // 60, minutes % 60)
+    return suffix
+
+def _resolve_timezone(default_timezone):
+    if isinstance(default_timezone, basestring):
+        if default_timezone.upper() == 'UTC':
+            return UTC
+        elif default_timezone.lower() == 'local':
+            return local_timezone()
+        return parse_timezone(default_timezone)
+    return default_timezone
+
+_DATE_FORMAT = '%04d-%02d-%02dT%02d:%02d:%02d.%06d'
+
 def print_date(dt, default_timezone=None):
     if dt == 'now':
         dt = datetime.now()
         #default_timezone = local_timezone()
-    s = '{dt.year}-{dt.month:02}-{dt.day:02}T{dt.hour:02}:{dt.minute:02}:{dt.second:02}.{dt.microsecond:06}'.format(dt=dt)
-    tzinfo = dt.tzinfo
-    if not tzinfo:
-        if isinstance(default_timezone, basestring):
-            if default_timezone.upper() == 'UTC':
-                tzinfo = UTC
-            elif default_timezone.lower() == 'local':
-                tzinfo = local_timezone()
-            else:
-                tzinfo = parse_timezone(default_timezone)
-        else:
-            tzinfo = default_timezone
+    s = _DATE_FORMAT % (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond)
+    tzinfo = dt.tzinfo or _resolve_timezone(default_timezone)
     if tzinfo:
-        offset = tzinfo.utcoffset(dt).total_seconds()
-        minutes = int(offset / 60)
-        if minutes == 0:
-            s += 'Z'
-        else:
-            hours = minutes / 60
-            minutes = minutes % 60
-            s += '{hours:+03}:{minutes:02}'.format(hours=hours,minutes=minutes)
+        s += _tz_suffix(tzinfo, dt)
     return s
-        
-        
\ No newline at end of file
+
+def print_dates(dts, default_timezone=None):
+    """Formats a list of datetimes like print_date, resolving the default
+    timezone once for the whole list."""
+    default_timezone = _resolve_timezone(default_timezone)
+    dates = []
+    for dt in dts:
+        s = _DATE_FORMAT % (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond)
+        tzinfo = dt.tzinfo or default_timezone
+        if tzinfo:
+            s += _tz_suffix(tzinfo, dt)
+        dates.append(s)
+    return dates
+
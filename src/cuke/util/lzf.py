@@ -0,0 +1,190 @@
+"""LZF compression, as used by the binary_compressed layout of PCD files.
+
+This is a Python implementation of the LZF format of liblzf, with the match
+search of compression vectorized with numpy. If the python-lzf extension
+module is installed, it is used instead.
+"""
+from __future__ import absolute_import
+
+__all__ = ["compress", "decompress", "LZFError"]
+
+import numpy
+
+try:
+    import lzf as _lzf
+except ImportError:
+    _lzf = None
+
+# Longest back reference and farthest offset of the LZF format
+_MAX_LIT = 1 << 5
+_MAX_OFF = 1 << 13
+_MAX_REF = (1 << 8) + (1 << 3)
+
+_JUMP_LEVELS = 6
+
+class LZFError(ValueError):
+    """Raised when LZF data is corrupt"""
+
+def decompress(data, expected_size=None):
+    """Decompresses LZF data, checking the result against expected_size if
+    it is given."""
+    if _lzf is not None and expected_size is not None:
+        out = _lzf.decompress(str(data), expected_size)
+        if out is None or len(out) != expected_size:
+            raise LZFError("LZF data does not decompress to %d bytes" % expected_size)
+        return out
+    data = bytearray(data)
+    n = len(data)
+    out = bytearray()
+    i = 0
+    while i < n:
+        ctrl = data[i]
+        i += 1
+        if ctrl < _MAX_LIT:
+            length = ctrl + 1
+            if i + length > n:
+                raise LZFError("LZF literal run past the end of the data")
+            out += data[i:i+length]
+            i += length
+            continue
+        length = ctrl >> 5
+        if length == 7:
+            if i >= n:
+                raise LZFError("LZF back reference past the end of the data")
+            length += data[i]
+            i += 1
+        if i >= n:
+            raise LZFError("LZF back reference past the end of the data")
+        length += 2
+        ref = len(out) - ((ctrl & 0x1f) << 8) - data[i] - 1
+        i += 1
+        if ref < 0:
+            raise LZFError("LZF back reference before the start of the data")
+        # Overlapping references repeat the bytes between ref and the end
+        while length > 0:
+            chunk = out[ref:ref+length]
+            out += chunk
+            ref += len(chunk)
+            length -= len(chunk)
+    if expected_size is not None and len(out) != expected_size:
+        raise LZFError("LZF data decompressed to %d bytes, expected %d" % (len(out), expected_size))
+    return str(out)
+
+def _match_candidates(data):
+    """Finds, for each position that repeats the 3 bytes at an earlier
+    position within _MAX_OFF, that most recent earlier position and the
+    length of the match, vectorized with numpy."""
+    n = len(data)
+    b = numpy.frombuffer(data, dtype=numpy.uint8)
+    pos = numpy.arange(n - 2, dtype=numpy.int64)
+    # Sorting the 3 bytes at each position with the position in the low bits
+    # puts the positions of each key in order
+    keys = (b[:-2].astype(numpy.int64) << 16) | (b[1:-1].astype(numpy.int64) << 8) | b[2:]
+    keys = numpy.sort((keys << 32) | pos)
+    order = keys & 0xffffffff
+    same = (keys[1:] >> 32) == (keys[:-1] >> 32)
+    prev = numpy.full(n - 2, -1, dtype=numpy.int64)
+    prev[order[1:][same]] = order[:-1][same]
+    found = (prev >= 0) & (pos - prev <= _MAX_OFF)
+    pos = pos[found]
+    ref = prev[found]
+    if not len(pos):
+        return pos, ref, pos
+    # Match lengths are extended 8 bytes at a time, comparing the 8-byte
+    # windows starting at each position, padded so every window is in range
+    padded = numpy.zeros(n + _MAX_REF + 8, dtype=numpy.uint8)
+    padded[:n] = b
+    windows = numpy.zeros(n + _MAX_REF, dtype=numpy.uint64)
+    for k in range(8):
+        windows |= padded[k:k+len(windows)].astype(numpy.uint64) << numpy.uint64(8 * k)
+    # A match continues the match at the next position if it has the same
+    # offset, so only the last position of each run of these is extended
+    continued = (pos[1:] == pos[:-1] + 1) & (pos[1:] - ref[1:] == pos[:-1] - ref[:-1])
+    run_ends = numpy.flatnonzero(numpy.append(~continued, True))
+    lengths = numpy.zeros(len(pos), dtype=numpy.int64)
+    active = run_ends
+    while len(active):
+        diff = windows[pos[active] + lengths[active]] ^ windows[ref[active] + lengths[active]]
+        equal = diff == 0
+        lengths[active[equal]] += 8
+        # The lowest set bit of the difference is in the first unequal byte
+        diff = diff[~equal]
+        lowest = diff & (~diff + numpy.uint64(1))
+        lengths[active[~equal]] += numpy.log2(lowest.astype(numpy.float64)).astype(numpy.int64) // 8
+        active = active[equal]
+        active = active[lengths[active] < _MAX_REF]
+    run_end = numpy.full(len(pos), len(pos), dtype=numpy.int64)
+    run_end[run_ends] = run_ends
+    run_end = numpy.minimum.accumulate(run_end[::-1])[::-1]
+    lengths = pos[run_end] - pos + lengths[run_end]
+    numpy.minimum(lengths, numpy.minimum(_MAX_REF, n - pos), out=lengths)
+    return pos, ref, lengths
+
+def _take_greedily(pos, lengths):
+    """Returns the indices of the matches taken by a greedy parse, in which
+    each match taken is followed by the first candidate after its end."""
+    # The index of the first candidate at or after a position is the number
+    # of candidates before it
+    candidates = numpy.zeros(pos[-1] + _MAX_REF + 2 if len(pos) else 1, dtype=numpy.int64)
+    candidates[pos + 1] = 1
+    following = numpy.append(numpy.cumsum(candidates)[pos + lengths], len(pos))
+    # Pointer jumping: jumps[k] leads 2**k matches ahead, so the parse is
+    # followed in Python only every 2**_JUMP_LEVELS matches
+    jumps = [following]
+    for _ in range(_JUMP_LEVELS):
+        jumps.append(jumps[-1][jumps[-1]])
+    far = jumps.pop()
+    taken = []
+    j = 0
+    while j < len(pos):
+        taken.append(j)
+        j = far[j]
+    taken = numpy.array(taken, dtype=numpy.int64)
+    for jump in reversed(jumps):
+        taken = numpy.concatenate((taken, jump[taken]))
+    return numpy.sort(taken[taken < len(pos)])
+
+def _encode(data, pos, ref, lengths):
+    """Writes literal runs and the given back references as LZF."""
+    n = len(data)
+    # Each back reference is preceded by a run of literals, and the last run
+    # ends the data; runs are split into chunks of up to _MAX_LIT bytes
+    starts = numpy.concatenate(([0], pos + lengths))
+    runs = numpy.append(pos, n) - starts
+    chunks = (runs + _MAX_LIT - 1) // _MAX_LIT
+    ref_sizes = numpy.append(numpy.where(lengths - 2 < 7, 2, 3), 0)
+    ends = numpy.cumsum(runs + chunks + ref_sizes)
+    out_starts = ends - runs - chunks - ref_sizes
+    out = numpy.empty(ends[-1], dtype=numpy.uint8)
+    # Literal chunk headers and the literals after them
+    run_of_chunk = numpy.repeat(numpy.arange(len(runs)), chunks)
+    chunk = numpy.arange(len(run_of_chunk)) - numpy.repeat(numpy.cumsum(chunks) - chunks, chunks)
+    out[out_starts[run_of_chunk] + chunk * (_MAX_LIT + 1)] = (
+        numpy.minimum(runs[run_of_chunk] - chunk * _MAX_LIT, _MAX_LIT) - 1)
+    run_of_literal = numpy.repeat(numpy.arange(len(runs)), runs)
+    literal = numpy.arange(len(run_of_literal)) - numpy.repeat(numpy.cumsum(runs) - runs, runs)
+    out[out_starts[run_of_literal] + literal + literal // _MAX_LIT + 1] = (
+        numpy.frombuffer(data, dtype=numpy.uint8)[starts[run_of_literal] + literal])
+    # Back references, with the length in a second byte if it is long
+    at = (out_starts + runs + chunks)[:-1]
+    off = pos - ref - 1
+    out[at] = (numpy.minimum(lengths - 2, 7) << 5) | (off >> 8)
+    long_refs = lengths - 2 >= 7
+    out[at[long_refs] + 1] = lengths[long_refs] - 2 - 7
+    out[at + ref_sizes[:-1] - 1] = off & 0xff
+    return out.tobytes()
+
+def compress(data):
+    """Compresses data with LZF."""
+    data = str(data)
+    if _lzf is not None:
+        out = _lzf.compress(data)
+        if out is not None:
+            return out
+    if len(data) < 3:
+        pos = ref = lengths = numpy.zeros((0,), dtype=numpy.int64)
+    else:
+        pos, ref, lengths = _match_candidates(data)
+        taken = _take_greedily(pos, lengths)
+        pos, ref, lengths = pos[taken], ref[taken], lengths[taken]
+    return _encode(data, pos, ref, lengths)
@@ -0,0 +1,80 @@
+import datetime
+import unittest
+
+import numpy
+
+from cuke.serializer import serialize, deserialize, SerializationError
+from cuke.serializers import Timestamp, Duration
+from cuke.util import dod
+
+class DODTest(unittest.TestCase):
+    def _round_trip(self, values):
+        values = numpy.asarray(values, dtype=numpy.int64)
+        data = dod.encode(values)
+        result = dod.decode(data)
+        self.assertEqual(result.dtype, numpy.int64)
+        numpy.testing.assert_array_equal(result, values)
+        return data
+
+    def test_empty(self):
+        self._round_trip([])
+
+    def test_one_value(self):
+        self._round_trip([1500000000123456789])
+        self._round_trip([-5])
+
+    def test_regular_spacing(self):
+        values = 1500000000 * 10**9 + numpy.arange(1000) * 10**7
+        data = self._round_trip(values)
+        # The header, one multi-byte first difference and then zeros
+        self.assertLess(len(data), 1000 + 20)
+
+    def test_negative_deltas(self):
+        self._round_trip([10, 5, 7, -3, -3, 100, -100])
+        self._round_trip(numpy.arange(100)[::-1])
+
+    def test_large_gaps(self):
+        # Differences that need multi-byte varints, up to the int64 limits
+        big = 2**62
+        self._round_trip([0, 1, 2**20, 2**35 + 3, 2**35, big, -big, 0])
+        self._round_trip([-2**63, 2**63 - 1])
+
+    def test_corrupt_data(self):
+        data = dod.encode([1, 2, 4, 8])
+        for bad in [data[:5], data[:-1], data + b'\x00']:
+            with self.assertRaises(dod.DODError):
+                dod.decode(bad)
+
+class TimeListTest(unittest.TestCase):
+    def test_timestamp_list(self):
+        values = [1500000000.0, 1500000000.25, 1500000001.0, 1499999999.5]
+        data = serialize(Timestamp.List, values, 'dod')
+        self.assertEqual(deserialize(Timestamp.List, data, 'dod'), values)
+        self.assertEqual(deserialize(Timestamp.List, serialize(Timestamp.List, [], 'dod'), 'dod'), [])
+
+    def test_timestamp_list_datetimes(self):
+        values = [datetime.datetime(2017, 1, 1, 12, 0, 0, 250000), datetime.datetime(2017, 1, 1, 12, 0, 1)]
+        data = serialize(Timestamp.datetime.List, values, 'dod')
+        self.assertEqual(deserialize(Timestamp.datetime.List, data, 'dod'), values)
+
+    def test_timestamp_list_numpy(self):
+        values = numpy.array([1500000000123456789, 1500000000123456790, 1500000000000000000], dtype='datetime64[ns]')
+        data = serialize(Timestamp.List.numpy, values, 'dod')
+        numpy.testing.assert_array_equal(deserialize(Timestamp.List.numpy, data, 'dod'), values)
+
+    def test_duration_list(self):
+        values = [0.5, 0.25, -1.0, 3600.0]
+        data = serialize(Duration.List, values, 'dod')
+        self.assertEqual(deserialize(Duration.List, data, 'dod'), values)
+        data = serialize(Duration.ms.List, [1.0, 2.0], 'dod')
+        self.assertEqual(deserialize(Duration.ns.List, data, 'dod'), [1e6, 2e6])
+
+    def test_scalar_dod(self):
+        for serializer in [Timestamp, Duration]:
+            with self.assertRaises(SerializationError):
+                serialize(serializer, 1.5, 'dod')
+            with self.assertRaises(SerializationError):
+                deserialize(serializer, dod.encode([1]), 'dod')
+
+if __name__ == '__main__':
+    unittest.main()
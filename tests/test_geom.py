@@ -0,0 +1,63 @@
+import unittest
+
+import numpy
+
+from cuke.serializer import serialize, deserialize, SerializationError
+from cuke.serializers import Pose, Rotation
+from cuke.translators import transformations
+from cuke.translators.geom_numpy import pose_to_pq
+
+def _pose():
+    T = transformations.euler_matrix(0.1, 0.2, 0.3)
+    T[0:3,3] = (1, 2, 3)
+    return T
+
+class PoseTest(unittest.TestCase):
+    def test_pq_round_trip(self):
+        T = _pose()
+        p, q = T[0:3,3], transformations.quaternion_from_matrix(T)
+        for data in [(p, q), numpy.hstack((p, q)), (p.reshape((3,1)), q)]:
+            wire_data = serialize(Pose.pq, data, 'pq.array')
+            numpy.testing.assert_allclose(deserialize(Pose.mat, wire_data, 'pq.array'), T, atol=1e-12)
+
+    def test_mismatched_internal_format(self):
+        # Data that does not have the shape of the internal format is encoded
+        # as its inferred type, as if no internal format was given
+        T = _pose()
+        p, q = T[0:3,3], transformations.quaternion_from_matrix(T)
+        for serializer, data in [(Pose.pq, T), (Pose.pq, numpy.eye(4)), (Pose.mat, (p, q)), (Pose.pr, (p, q))]:
+            for wire_format in ['pq.array', 'rowmajor.float64']:
+                self.assertEqual(serialize(serializer, data, wire_format), serialize(Pose, data, wire_format))
+
+    def test_bad_pq_array_length(self):
+        with self.assertRaises(SerializationError):
+            deserialize(Pose.mat, b'\0' * 20, 'pq.array')
+
+class PoseToPQTest(unittest.TestCase):
+    def test_formats(self):
+        T = _pose()
+        p, q = T[0:3,3], transformations.quaternion_from_matrix(T)
+        pq = numpy.hstack((p, q))
+        for data, internal_format in [((p, q), 'pq'), ((p, q), None), (pq, 'pq'), (T, 'mat'), (T, None),
+                                      ((p, T[0:3,0:3]), 'pr'), (T, 'pq')]:
+            numpy.testing.assert_allclose(pose_to_pq(data, internal_format), pq, atol=1e-12)
+
+class RotationTest(unittest.TestCase):
+    def test_q_round_trip(self):
+        q = transformations.quaternion_from_matrix(_pose())
+        wire_data = serialize(Rotation.q, q, 'q.array')
+        numpy.testing.assert_allclose(deserialize(Rotation.q, wire_data, 'q.array'), q, atol=1e-12)
+
+    def test_mismatched_internal_format(self):
+        R = _pose()[0:3,0:3]
+        for wire_format in ['q.array', 'matrix.float64']:
+            self.assertEqual(serialize(Rotation.q, R, wire_format), serialize(Rotation, R, wire_format))
+        wire_data = serialize(Rotation.q, numpy.eye(3), 'q.array')
+        numpy.testing.assert_allclose(deserialize(Rotation.q, wire_data, 'q.array'), (0, 0, 0, 1))
+
+    def test_bad_q_array_length(self):
+        with self.assertRaises(SerializationError):
+            deserialize(Rotation.q, b'\0' * 12, 'q.array')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+import numpy
+
+from cuke.serializer import serialize, deserialize
+from cuke.serializers import PointCloud
+from cuke.util import lzf
+
+def _cloud(points=1000):
+    rng = numpy.random.RandomState(0)
+    cloud = numpy.zeros((points,), dtype=[('x','<f4'),('y','<f4'),('z','<f4'),('intensity','<f4')])
+    cloud['x'] = numpy.round(rng.randn(points), 2)
+    cloud['y'] = numpy.arange(points) * 0.01
+    cloud['z'] = 1.5
+    cloud['intensity'] = rng.randint(0, 4, size=points)
+    return cloud
+
+class LZFTest(unittest.TestCase):
+    def test_round_trip(self):
+        rng = numpy.random.RandomState(0)
+        cases = [b'', b'a', b'ab', b'abc', b'aaaa', b'abcabcabc', b'x' * 1000,
+                 rng.randint(0, 256, size=5000).astype(numpy.uint8).tobytes(),
+                 b'hello world ' * 500, _cloud().tobytes()]
+        for data in cases:
+            compressed = lzf.compress(data)
+            self.assertEqual(lzf.decompress(compressed, len(data)), data)
+
+    def test_long_and_far_matches(self):
+        # Runs longer than the longest back reference, and repeats farther
+        # apart than the farthest offset
+        rng = numpy.random.RandomState(1)
+        block = rng.randint(0, 256, size=9000).astype(numpy.uint8).tobytes()
+        for data in [b'\0' * 10000, block + block, (b'ab' * 300 + b'c') * 40]:
+            self.assertEqual(lzf.decompress(lzf.compress(data), len(data)), data)
+
+    def test_compresses(self):
+        data = _cloud().tobytes()
+        self.assertLess(len(lzf.compress(data)), len(data))
+
+class PointCloudTest(unittest.TestCase):
+    def _round_trip(self, wire_format, data_format):
+        cloud = _cloud()
+        wire_data = serialize(PointCloud.numpy, cloud, wire_format)
+        self.assertIn('DATA %s\n' % data_format, str(wire_data))
+        result = deserialize(PointCloud.numpy, wire_data, wire_format)
+        self.assertEqual(result.dtype.names, cloud.dtype.names)
+        for name in cloud.dtype.names:
+            numpy.testing.assert_array_equal(result[name], cloud[name])
+
+    def test_binary_round_trip(self):
+        self._round_trip('pcd.binary', 'binary')
+
+    def test_binary_compressed_round_trip(self):
+        self._round_trip('pcd.binary_compressed', 'binary_compressed')
+
+    def test_zlib_round_trip(self):
+        self._round_trip('pcd.zlib', 'binary_zlib')
+
+    def test_organized_compressed_round_trip(self):
+        cloud = _cloud(12).reshape((3,4))
+        for wire_format in ['pcd.binary_compressed', 'pcd.zlib']:
+            result = deserialize(PointCloud.numpy, serialize(PointCloud.numpy, cloud, wire_format), wire_format)
+            self.assertEqual(result.shape, (3,4))
+            numpy.testing.assert_array_equal(result['x'], cloud['x'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from cuke.serializer import BinaryWithHeader, SerializationError, StringTable
+
+FIELDS = ((str,'frame'),(float,'stamp'))
+
+def _header(table):
+    return BinaryWithHeader(*FIELDS, string_table=table)
+
+class StringTableTest(unittest.TestCase):
+    def test_round_trip(self):
+        enc = _header(StringTable(['map']))
+        dec = _header(StringTable(['map']))
+        frames = ['map','odom','odom','map','base']
+        msgs = [enc.pack(b'', frame=f, stamp=1.0) for f in frames]
+        self.assertEqual([dec.unpack_from(m)[0]['frame'] for m in msgs], frames)
+        # Repeated strings are sent as codes
+        self.assertLess(len(msgs[2]), len(msgs[1]))
+    
+    def test_local_and_remote_codes_are_separate(self):
+        table = StringTable()
+        local = _header(table)
+        remote = _header(StringTable())
+        local_msg = local.pack(b'', frame='odom', stamp=1.0)
+        remote_msg = remote.pack(b'', frame='map', stamp=1.0)
+        # Both strings have code 0 on their own side
+        self.assertEqual(local.unpack_from(remote_msg)[0]['frame'], 'map')
+        self.assertEqual(table.encode('odom'), (0, False))
+        self.assertEqual(table.decode(0), 'map')
+    
+    def test_two_sources(self):
+        source1 = _header(StringTable())
+        source2 = _header(StringTable())
+        msg1 = source1.pack(b'', frame='odom', stamp=1.0)
+        msg2 = source2.pack(b'', frame='map', stamp=2.0)
+        
+        # One table per source resolves both streams
+        dec1 = _header(StringTable())
+        dec2 = _header(StringTable())
+        self.assertEqual(dec1.unpack_from(msg1)[0]['frame'], 'odom')
+        self.assertEqual(dec2.unpack_from(msg2)[0]['frame'], 'map')
+        
+        # A shared table rejects the conflicting definition
+        shared = _header(StringTable())
+        self.assertEqual(shared.unpack_from(msg1)[0]['frame'], 'odom')
+        self.assertRaises(SerializationError, shared.unpack_from, msg2)
+        self.assertEqual(shared.unpack_from(msg1)[0]['frame'], 'odom')
+    
+    def test_late_decoder(self):
+        enc = _header(StringTable(redefine_every=4))
+        msgs = [enc.pack(b'', frame='odom', stamp=float(i)) for i in range(5)]
+        dec = _header(StringTable())
+        self.assertRaises(SerializationError, dec.unpack_from, msgs[1])
+        self.assertEqual(dec.unpack_from(msgs[4])[0]['frame'], 'odom')
+        self.assertEqual(dec.unpack_from(msgs[1])[0]['frame'], 'odom')
+
+if __name__ == '__main__':
+    unittest.main()
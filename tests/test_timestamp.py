@@ -0,0 +1,32 @@
+import datetime
+import unittest
+
+import numpy
+
+from cuke.serializer import serialize, deserialize
+from cuke.serializers import Timestamp
+from cuke.util import iso8601
+
+class TimestampListISOTest(unittest.TestCase):
+    def test_lists_are_utc(self):
+        # Lists are written in UTC with Z whatever their container
+        seconds = [1483272000.25, 1498910401.0]
+        expected = ['2017-01-01T12:00:00.250000Z', '2017-07-01T12:00:01.000000Z']
+        datetimes = [datetime.datetime.fromtimestamp(s) for s in seconds]
+        self.assertEqual(serialize(Timestamp.datetime.List, datetimes, 'iso'), expected)
+        self.assertEqual(serialize(Timestamp.List, datetimes, 'iso'), expected)
+        self.assertEqual(serialize(Timestamp.List, seconds, 'iso'), expected)
+        self.assertEqual(serialize(Timestamp.List, numpy.array(seconds), 'iso'), expected)
+        datetime64 = numpy.array([e[:-1] for e in expected], dtype='datetime64[ns]')
+        self.assertEqual(serialize(Timestamp.List.numpy, datetime64, 'iso'), expected)
+
+    def test_aware_datetimes(self):
+        dts = [datetime.datetime(2017, 7, 1, 14, 0, 1, tzinfo=iso8601.parse_timezone('+02:00'))]
+        self.assertEqual(serialize(Timestamp.datetime.List, dts, 'iso'), ['2017-07-01T12:00:01.000000Z'])
+
+    def test_round_trip(self):
+        dts = [datetime.datetime(2017, 1, 1, 12, 0, 0, 250000, tzinfo=iso8601.UTC)]
+        self.assertEqual(deserialize(Timestamp.datetime.List, serialize(Timestamp.datetime.List, dts, 'iso'), 'iso'), dts)
+
+if __name__ == '__main__':
+    unittest.main()